@@ -0,0 +1,275 @@
+import argparse
+import json
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import numpy as np
+from immersion_scanner_lib import immersion_scanner, connection_types
+from scanner_fleet_lib import scanner_fleet
+from scan_storage_lib import scan_store
+from scanner_session_lib import scanner_session
+
+
+def post_process_scan(store_path, object_directory, angular_resolution=100, plot=True):
+    # Runs in the post processing processes, the scan is read from its store.
+    from mesh_reconstruction_lib import revolution_mesh
+    start_time = time.perf_counter()
+    object_directory = Path(object_directory)
+    store = scan_store(store_path)
+    result = store.get_scan_result()
+    if (len(result.layer_volumes) == 0):
+        store.close()
+        raise ValueError("The scan has less than two layers")
+
+    outputs = {}
+    mesh = revolution_mesh.from_scan_result(result, angular_resolution)
+    outputs["mesh"] = str(object_directory / "mesh.stl")
+    mesh.write_stl(outputs["mesh"])
+    if (plot):
+        from matplotlib.figure import Figure
+        figure = Figure(figsize=(6, 6))
+        immersion_scanner.add_subplot_to_fig_from_measures(figure, result.layer_volumes, result.heights_m, layer_heights=result.layer_heights)
+        outputs["plot"] = str(object_directory / "plot.png")
+        figure.savefig(outputs["plot"], dpi=100)
+
+    summary = {"layer_volumes": result.layer_volumes.tolist(), "heights": result.heights_m.tolist(), "layer_heights": result.layer_heights.tolist(),
+               "radiuses": immersion_scanner.get_radiuses(result.layer_volumes, result.layer_heights).tolist(),
+               "total_volume": abs(float(np.sum(result.layer_volumes)))}
+    outputs["summary"] = str(object_directory / "summary.json")
+    with open(outputs["summary"], "w") as file:
+        json.dump(summary, file, indent=4)
+    store.close()
+    outputs["total_volume"] = summary["total_volume"]
+    outputs["post_processing_time"] = time.perf_counter() - start_time
+    return outputs
+
+
+class batch_runner:
+    # Runs a queue of scan jobs back to back on one or more scanners, with
+    # no operator. Every object is scanned into the scan_store
+    # output_directory/object_id/scan, and its mesh, plot and summary are
+    # made in a process pool while the next objects are scanned. The
+    # outcome of every job is appended to results.jsonl. Objects already
+    # scanned are skipped and unfinished scans are resumed, so a queue can
+    # be run again after a failure.
+    # A job is a JSON object with object_id, layer_height, layer_count,
+    # averages, transport and, optionally, options for scann_object. The
+    # transport is {"type": "visa", "resource_name": ...}, {"type": "mqtt",
+    # "brocker": ..., "port": ..., "name": ...} or {"type": "simulated"},
+    # the jobs with the same transport run on the same scanner. The scanners
+    # connected by the runner keep their link alive with a scanner_session.
+
+    job_fields = ("object_id", "layer_height", "layer_count", "averages", "transport", "options")
+    scan_options = ("volume_tolerance", "time_budget", "pipelined", "streaming")
+    results_file_name = "results.jsonl"
+
+    def __init__(self, output_directory, post_processing_workers=None, angular_resolution=100, plot=True, scanners=None):
+        # scanners are scanners already connected, by name. Jobs use them
+        # with the transport {"name": name}.
+        self.output_directory = Path(output_directory)
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        self.post_processing_workers = post_processing_workers
+        self.angular_resolution = angular_resolution
+        self.plot = plot
+        self.scanners = dict(scanners) if scanners != None else {}
+        self.sessions = {}
+        self.__results_lock = threading.Lock()
+
+
+    @staticmethod
+    def read_jobs(path, default_transport=None):
+        # One job per line, empty lines and lines starting with # are skipped.
+        jobs = []
+        with open(path, "r") as file:
+            for line_number, line in enumerate(file, 1):
+                if (line.strip() == "" or line.lstrip().startswith("#")):
+                    continue
+                try:
+                    job = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError("Line " + str(line_number) + " of " + str(path) + " is not valid JSON: " + str(e))
+                if (default_transport != None):
+                    job.setdefault("transport", default_transport)
+                batch_runner.check_job(job, "line " + str(line_number))
+                jobs.append(job)
+        return jobs
+
+
+    @staticmethod
+    def check_job(job, place="job"):
+        for field in job:
+            if (field not in batch_runner.job_fields):
+                raise ValueError("Unknown field " + str(field) + " in " + place)
+        for field in batch_runner.job_fields[:-1]:
+            if (field not in job):
+                raise ValueError("Missing field " + field + " in " + place)
+        object_id = str(job["object_id"])
+        if (object_id in ("", ".", "..") or "/" in object_id or "\\" in object_id):
+            raise ValueError("The object_id in " + place + " can not be used as a directory name")
+        if (job["layer_height"] <= 0 or int(job["layer_count"]) < 1 or int(job["averages"]) < 1):
+            raise ValueError("The layer height, layer count and averages in " + place + " must be positive")
+        for option in job.get("options", {}):
+            if (option not in batch_runner.scan_options):
+                raise ValueError("Unknown scan option " + str(option) + " in " + place)
+
+
+    @staticmethod
+    def get_scanner_name(transport):
+        if ("name" in transport):
+            return str(transport["name"])
+        return json.dumps(transport, sort_keys=True)
+
+
+    @staticmethod
+    def create_scanner(transport):
+        transport_type = transport.get("type")
+        if (transport_type == "visa"):
+            return immersion_scanner(connection_types.visa, resource_name=transport["resource_name"])
+        if (transport_type == "mqtt"):
+            # Named scanners use the topics of scanner_fleet.from_mqtt.
+            name = transport.get("name")
+            if (name == None):
+                return immersion_scanner(connection_types.mqtt, mqtt_brocker=transport["brocker"], mqtt_brocker_port=transport.get("port", 1883))
+            return immersion_scanner(connection_types.mqtt, mqtt_brocker=transport["brocker"], mqtt_brocker_port=transport.get("port", 1883),
+                                     mqtt_client_id="immersion_scanner_" + name, mqtt_write_topic=name + "/commands", mqtt_read_topic=name + "/prints")
+        if (transport_type == "simulated"):
+            from scanner_simulator_lib import simulated_instrument
+            return immersion_scanner(connection_types.simulated, simulated_instrument=simulated_instrument(**transport.get("simulator", {})))
+        raise ValueError("Unknown transport: " + json.dumps(transport))
+
+
+    def run(self, jobs):
+        # Returns the records written to results.jsonl for these jobs.
+        object_ids = [str(job["object_id"]) for job in jobs]
+        if (len(set(object_ids)) != len(object_ids)):
+            raise ValueError("Every job needs its own object_id")
+        for job in jobs:
+            self.check_job(job)
+            scanner_name = self.get_scanner_name(job["transport"])
+            if (scanner_name not in self.scanners):
+                print("Connecting scanner " + scanner_name)
+                self.scanners[scanner_name] = self.create_scanner(job["transport"])
+                self.sessions[scanner_name] = scanner_session(self.scanners[scanner_name])
+
+        records = []
+        fleet = scanner_fleet(self.scanners)
+        # Forking while the scanner threads hold locks could leave them held
+        # in the new processes, so these are spawned.
+        with ProcessPoolExecutor(max_workers=self.post_processing_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            scan_jobs = {}
+            for job in jobs:
+                future = self.__submit_job(fleet, job)
+                if (future == None):
+                    records.append(self.__write_result(job, {"state": "skipped"}))
+                else:
+                    scan_jobs[future] = job
+
+            post_processing_jobs = {}
+            try:
+                for future in as_completed(scan_jobs):
+                    self.__scan_done(fleet, pool, scan_jobs.pop(future), future, records, post_processing_jobs)
+            except KeyboardInterrupt:
+                print("Cancelling the scans, the measured layers are kept")
+                fleet.cancel_all()
+                fleet.wait()
+                for future, job in scan_jobs.items():
+                    self.__scan_done(fleet, pool, job, future, records, post_processing_jobs)
+
+            for future in as_completed(post_processing_jobs):
+                job, record = post_processing_jobs[future]
+                try:
+                    record.update(future.result())
+                except Exception as e:
+                    record["post_processing_error"] = str(e)
+                records.append(self.__write_result(job, record))
+                print("Post processed " + str(job["object_id"]))
+        fleet.close()
+        return records
+
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
+
+
+    def __submit_job(self, fleet, job):
+        scanner_name = self.get_scanner_name(job["transport"])
+        store_path = self.__get_store_path(job)
+        if (not store_path.exists()):
+            return fleet.submit_scan(str(job["object_id"]), job["layer_height"], int(job["layer_count"]), int(job["averages"]), scanner_name,
+                                     store_path=store_path, **job.get("options", {}))
+        store = scan_store(store_path)
+        layers_left = int(job["layer_count"]) + 1 - len(store.layers)
+        store.close()
+        if (layers_left <= 0):
+            print("Skipping " + str(job["object_id"]) + ", already scanned")
+            return None
+        print("Resuming " + str(job["object_id"]) + " with " + str(layers_left) + " layers left")
+        return fleet.submit_resume(str(job["object_id"]), store_path, layers_left, scanner_name)
+
+
+    def __scan_done(self, fleet, pool, job, future, records, post_processing_jobs):
+        # Scans with at least two layers are post processed, even if they
+        # were cancelled.
+        record = self.__get_scan_record(fleet, job, future)
+        if (record["layers"] >= 2):
+            print("Scanned " + str(job["object_id"]) + ", post processing")
+            post_processing_jobs[pool.submit(post_process_scan, str(self.__get_store_path(job)), str(self.__get_object_directory(job)),
+                                             self.angular_resolution, self.plot)] = (job, record)
+        else:
+            print("Scan of " + str(job["object_id"]) + " " + record["state"] + ": " + str(record.get("error")))
+            records.append(self.__write_result(job, record))
+
+
+    def __get_scan_record(self, fleet, job, future):
+        progress = [item for item in fleet.get_progress() if item["name"] == str(job["object_id"])][-1]
+        record = {"state": progress["state"], "scanner": progress["scanner"], "error": progress["error"],
+                  "scan_started": progress["started"], "scan_finished": progress["finished"], "layers": 0}
+        if (future.done() and not future.cancelled() and future.exception() == None):
+            record["layers"] = int(future.result().measured_count)
+        return record
+
+
+    def __write_result(self, job, record):
+        record = dict(record, object_id=str(job["object_id"]), store=str(self.__get_store_path(job)), time=time.time())
+        with self.__results_lock:
+            with open(self.output_directory / self.results_file_name, "a") as file:
+                file.write(json.dumps(record) + "\n")
+        return record
+
+
+    def __get_object_directory(self, job):
+        return self.output_directory / str(job["object_id"])
+
+
+    def __get_store_path(self, job):
+        return self.__get_object_directory(job) / "scan"
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Runs a queue of scans without the window, see batch_runner.")
+    parser.add_argument("jobs", help="JSON lines file with one job per line")
+    parser.add_argument("--output", default="scans", help="directory for the scans, their meshes and plots and results.jsonl")
+    parser.add_argument("--transport", default=None, help="JSON transport of the jobs without one")
+    parser.add_argument("--post-processing-workers", type=int, default=None, help="processes for the meshes and plots")
+    parser.add_argument("--angular-resolution", type=int, default=100, help="segments of the meshes")
+    parser.add_argument("--no-plot", action="store_true", help="do not render the plots")
+    arguments = parser.parse_args(arguments)
+
+    default_transport = json.loads(arguments.transport) if arguments.transport != None else None
+    jobs = batch_runner.read_jobs(arguments.jobs, default_transport)
+    runner = batch_runner(arguments.output, arguments.post_processing_workers, arguments.angular_resolution, not arguments.no_plot)
+    try:
+        records = runner.run(jobs)
+    finally:
+        runner.close()
+    failed = [record for record in records if record["state"] == "failed" or "post_processing_error" in record]
+    print(str(len(records)) + " jobs, " + str(len(failed)) + " failed")
+    return 1 if len(failed) != 0 else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,43 @@
+import json
+import os
+import time
+from pathlib import Path
+
+
+class calibration_profiles:
+    # JSON file with the calibration of every device, keyed by the reply of
+    # the device to *IDN?. A profile has the load cell calibration, the
+    # steps of the axis per m and the drift rate measured in the last scans.
+
+    profile_fields = ("int_per_grame_calibration", "steps_per_m", "drift_rate")
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.profiles = {}
+        if (self.path.exists()):
+            with open(self.path, "r") as file:
+                self.profiles = json.load(file)
+
+
+    def get(self, device_id):
+        return self.profiles.get(device_id)
+
+
+    def set(self, device_id, **values):
+        for name in values:
+            if (name not in self.profile_fields):
+                raise ValueError("Unknown calibration field: " + str(name))
+        profile = dict(self.profiles.get(device_id, {}))
+        profile.update(values)
+        profile["updated"] = time.time()
+        self.profiles[device_id] = profile
+        return profile
+
+
+    def save(self):
+        # Written to a temporary file and renamed, so a crash never leaves
+        # half a file.
+        temporary_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temporary_path, "w") as file:
+            json.dump(self.profiles, file, indent=4)
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,50 @@
+import math
+import numpy as np
+
+
+class drift_model:
+    # Slow drift of the buoyancy readings, from the load cell or the liquid
+    # (evaporation, temperature), estimated from reference readings taken at
+    # the same position at different times, so the volume seen is always
+    # the same. The baseline is 0 at the first reference, linear between
+    # references and follows rate after the last one. rate is the least
+    # squares slope of the references, weighted to forget the ones older
+    # than rate_memory seconds, or the given rate until there are two.
+
+    def __init__(self, rate=0, rate_memory=math.inf):
+        self.rate = rate
+        self.rate_memory = rate_memory
+        self.reference_times = []
+        self.reference_values = []
+
+
+    def add_reference(self, time, value):
+        self.reference_times.append(float(time))
+        self.reference_values.append(float(value))
+        if (len(self.reference_times) >= 2):
+            self.rate = self.__get_rate()
+        return self.rate
+
+
+    def get_baseline(self, times):
+        # times can be a single time or an array of them.
+        times = np.asarray(times, dtype=np.float64)
+        if (len(self.reference_times) == 0):
+            return np.zeros(times.shape)
+        reference_times = np.array(self.reference_times)
+        baselines = np.array(self.reference_values) - self.reference_values[0]
+        baseline = np.interp(times, reference_times, baselines)
+        baseline = np.where(times > reference_times[-1], baselines[-1] + self.rate * (times - reference_times[-1]), baseline)
+        return np.where(times < reference_times[0], self.rate * (times - reference_times[0]), baseline)
+
+
+    def __get_rate(self):
+        times = np.array(self.reference_times)
+        values = np.array(self.reference_values)
+        weights = np.exp(-(times[-1] - times) / self.rate_memory)
+        mean_time = np.sum(weights * times) / np.sum(weights)
+        mean_value = np.sum(weights * values) / np.sum(weights)
+        spread = np.sum(weights * (times - mean_time) ** 2)
+        if (spread == 0):
+            return self.rate
+        return float(np.sum(weights * (times - mean_time) * (values - mean_value)) / spread)
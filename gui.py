@@ -1,22 +1,15 @@
-import math
 from pathlib import Path
+import queue
 import threading
 import time
 import tkinter as tk
 from tkinter import StringVar, ttk
 from tkinter.messagebox import showinfo
-from xmlrpc.server import SimpleXMLRPCRequestHandler
 from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
-from matplotlib.style import available
-import numpy as np
 from matplotlib.backends.backend_tkagg import (
     FigureCanvasTkAgg, NavigationToolbar2Tk)
-from matplotlib.patches import Circle
-from pyparsing import col
 from immersion_scanner_lib import immersion_scanner, connection_types
-import pyvisa
-import mpl_toolkits.mplot3d.art3d as art3d
+from mesh_reconstruction_lib import revolution_mesh
 
 
 class scanner_window:
@@ -26,6 +19,12 @@ class scanner_window:
     def __init__(self):
         self.current_scanned_object_data = None
         self.showing_wait_window = False
+        self.scans_directory = Path.home() / "Downloads"
+        self.worker_queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.redraw_interval = 0.5
+        self.last_draw_time = 0
+        self.pending_redraw = False
 
         self.root = tk.Tk()
         self.root.title("3D scanner")
@@ -178,6 +177,13 @@ class scanner_window:
         self.update_figure_button.grid(column=2, row=2, sticky="nsew")
         self.command_frame_buttons.append(self.update_figure_button)
 
+        self.cancel_button = ttk.Button(self.scann_buttons_frame, text="Cancel", command=self.cancel_button_clicked)
+        self.cancel_button.grid(column=1, row=2, sticky="nsew")
+        self.cancel_button['state'] = tk.DISABLED
+
+        self.scann_progress = tk.StringVar()
+        ttk.Label(self.scann_buttons_frame, textvariable=self.scann_progress).grid(column=0, row=3, columnspan=3, sticky=tk.W, padx=10, pady=3)
+
         self.figure_frame = tk.Frame(self.view_frame)
         self.figure_frame.grid(column=0, row=1, sticky="nsew")
 
@@ -212,23 +218,64 @@ class scanner_window:
         if (self.current_scanned_object_data == None):
             showinfo(title="Warning", message="No data for any scanned object. Please, scann some object.")
             return
-        self.sublplot.clear()
-        immersion_scanner.add_subplot_to_fig_from_measures(self.ploted_figure, self.current_scanned_object_data[0], self.current_scanned_object_data[1])
+        if (len(self.current_scanned_object_data.layer_volumes) < 2):
+            showinfo(title="Warning", message="At least two layers are needed to plot the scanned object.")
+            return
+        self.ploted_figure.clear()
+        self.sublplot = immersion_scanner.add_subplot_to_fig_from_measures(self.ploted_figure, self.current_scanned_object_data.layer_volumes,
+                                                                           self.current_scanned_object_data.heights_m,
+                                                                           layer_heights=self.current_scanned_object_data.layer_heights)
         self.canvas.draw_idle()
 
+    def run_in_background(self, function, on_done, *args, **kwargs):
+        # Runs an instrument operation in a worker thread. Its result and the
+        # scanned layers reach the Tk thread through worker_queue.
+        self.disable_buttons()
+
+        def work():
+            try:
+                self.worker_queue.put(("done", on_done, function(*args, **kwargs)))
+            except Exception as e:
+                self.worker_queue.put(("error", on_done, e))
+
+        threading.Thread(target=work, daemon=True).start()
+        self.root.after(100, self.process_worker_queue)
+
+    def process_worker_queue(self):
+        finished = False
+        while not self.worker_queue.empty():
+            message = self.worker_queue.get()
+            if (message[0] == "layer"):
+                self.add_scanned_layer(*message[1:])
+            elif (message[0] == "done"):
+                finished = True
+                if (message[1] != None):
+                    message[1](message[2])
+            elif (message[0] == "error"):
+                finished = True
+                showinfo(title="Error", message="The instrument operation failed: " + str(message[2]))
+                print(message[2])
+
+        if (self.pending_redraw and (finished or time.time() - self.last_draw_time > self.redraw_interval)):
+            self.canvas.draw_idle()
+            self.last_draw_time = time.time()
+            self.pending_redraw = False
+
+        if (finished):
+            self.cancel_button['state'] = tk.DISABLED
+            self.enable_buttons()
+        else:
+            self.root.after(100, self.process_worker_queue)
+
     def send_command(self):
-        self.busy()
-        self.root.update()
-        text_to_print = self.scanner.query_command(self.command_in_entry.get())
+        self.run_in_background(self.scanner.query_command, self.print_to_console, self.command_in_entry.get())
 
+    def print_to_console(self, text_to_print):
         self.console.configure(state='normal')
         self.console.insert("end", text_to_print)
         self.console.configure(state='disabled')
-        self.notbusy()
     
     def scann_figure(self):
-        self.busy()
-        self.root.update()
         try:
             lh = float(self.layer_height.get())
             lc = int(self.layers_number.get())
@@ -237,21 +284,85 @@ class scanner_window:
             showinfo(title="Error", message="Check ")
             print(e)
             return
-        self.current_scanned_object_data = self.scanner.scann_object(lh, lc, av)
-        self.notbusy()
+
+        self.live_layer_height = lh
+        self.live_layer_count = lc
+        self.live_averages = {}
+        self.live_heights = {}
+        self.live_layer_times = []
+        self.live_max_radius = 0
+        self.live_angular_resolution = immersion_scanner.get_plot_angular_resolution(lc)
+        self.ploted_figure.clear()
+        self.sublplot = self.ploted_figure.add_subplot(111, projection="3d")
+        self.canvas.draw_idle()
+
+        self.cancel_event.clear()
+        self.scann_progress.set("Scanning layer 1/" + str(lc + 1))
+        scan_path = self.scans_directory / ("scan_" + str(int(time.time())))
+        self.live_layer_times.append(time.time())
+        self.run_in_background(self.scanner.scann_object, self.scann_figure_done, lh, lc, av, store_path=scan_path,
+                               layer_callback=self.scanned_layer_callback, cancel_event=self.cancel_event)
+        self.cancel_button['state'] = tk.NORMAL
+
+    def scanned_layer_callback(self, index, height, average):
+        # Called from the scan thread, Tk is only used from process_worker_queue.
+        self.worker_queue.put(("layer", index, height, average))
+
+    def add_scanned_layer(self, index, height, average):
+        self.live_averages[index] = average
+        self.live_heights[index] = height
+        self.live_layer_times.append(time.time())
+        for i in (index, index + 1):
+            if (i - 1 in self.live_averages and i in self.live_averages):
+                volume = self.live_averages[i] - self.live_averages[i - 1]
+                radius = float(immersion_scanner.get_radiuses(volume, self.live_layer_height))
+                self.live_max_radius = max(self.live_max_radius, radius, 1e-9)
+                immersion_scanner.add_cilinders_to_axes(self.sublplot, [radius], [self.live_heights[i - 1]], self.live_layer_height,
+                                                        self.live_angular_resolution)
+        if (self.live_max_radius > 0):
+            self.sublplot.set_xlim(-self.live_max_radius, self.live_max_radius)
+            self.sublplot.set_ylim(-self.live_max_radius, self.live_max_radius)
+            self.sublplot.set_zlim(0, self.live_layer_height * self.live_layer_count)
+            self.pending_redraw = True
+
+        # The first interval also includes homing, so it is left out of the
+        # layer time once there are other layers.
+        layer_times = self.live_layer_times[1:] if len(self.live_layer_times) > 2 else self.live_layer_times
+        layer_time = (layer_times[-1] - layer_times[0]) / max(1, len(layer_times) - 1)
+        remaining_layers = self.live_layer_count + 1 - len(self.live_averages)
+        self.scann_progress.set("Layer %d/%d scanned, %.1f s per layer, %d s remaining" % (
+            len(self.live_averages), self.live_layer_count + 1, layer_time, remaining_layers * layer_time))
+
+    def scann_figure_done(self, scanned_object_data):
+        self.current_scanned_object_data = scanned_object_data
+        if (self.cancel_event.is_set()):
+            self.scann_progress.set("Scan cancelled after " + str(len(self.live_averages)) + " layers")
+        else:
+            self.scann_progress.set("Scan finished")
+        if (len(scanned_object_data.layer_volumes) >= 2):
+            self.update_figure()
+
+    def cancel_button_clicked(self):
+        self.cancel_event.set()
+        self.cancel_button['state'] = tk.DISABLED
+        self.scann_progress.set("Cancelling, waiting for the current layer to finish...")
 
     def download_button_clicked(self):
-        measures = self.current_scanned_object_data[0]
-        heights = self.current_scanned_object_data[0]
-        radiuses = [math.sqrt(abs(measure / ((heights[1] - heights[0]) * math.pi))) for measure in measures]
-        with open(Path.home() +"/Downloads/measures_" + str(time.time), 'w') as file:
-            file.write(str(radiuses))
+        if (self.current_scanned_object_data == None):
+            showinfo(title="Warning", message="No data for any scanned object. Please, scann some object.")
+            return
+        result = self.current_scanned_object_data
+        radiuses = immersion_scanner.get_radiuses(result.layer_volumes, result.layer_heights)
+        download_time = str(int(time.time()))
+        with open(self.scans_directory / ("measures_" + download_time + ".txt"), 'w') as file:
+            file.write(str(radiuses.tolist()))
             file.write("\n")
-            file.write(str(heights))
+            file.write(str(result.heights_m.tolist()))
             file.write("\n")
+        revolution_mesh.from_scan_result(result).write_stl(self.scans_directory / ("scan_" + download_time + ".stl"))
 
     def test_button_clicked(self):
-        self.scanner.measure_buoyancy_and_filter(1000)
+        self.run_in_background(self.scanner.measure_buoyancy_and_filter, None, 1000)
     
     def busy(self):
         self.root.call("tk","busy","hold", self.root)
@@ -262,23 +373,16 @@ class scanner_window:
         self.enable_buttons()
 
     def motor_off_button_clicked(self):
-        self.busy()
-        self.root.update()
-        self.scanner.set_motor_off()
-        self.notbusy()
+        self.run_in_background(self.scanner.set_motor_off, None)
     
     def motor_on_button_clicked(self):
-        self.busy()
-        self.root.update()
-        self.scanner.set_motor_on()
-        self.notbusy()
+        self.run_in_background(self.scanner.set_motor_on, None)
 
     def set_axis_home_button_clicked(self):
-        self.scanner.set_axis_home()
+        self.run_in_background(self.scanner.set_axis_home, None)
     
     def get_aviable_instruments(self):
-        rm = pyvisa.ResourceManager("@py")
-        self.aviable_visa_instruments_combobox["values"] = rm.list_resources()
+        self.aviable_visa_instruments_combobox["values"] = immersion_scanner.get_resource_manager().list_resources()
     
     def create_scanner(self):
         self.busy()
@@ -1,20 +1,25 @@
 import math
-from operator import concat
+import itertools
+import threading
 import time
-from tracemalloc import start
-from matplotlib import pyplot as plt
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import pyvisa
 from enum import Enum
-import paho.mqtt.client as mqtt
-from matplotlib.patches import Circle
-import mpl_toolkits.mplot3d.art3d as art3d
+from scan_storage_lib import scan_store
+from scan_result_lib import scan_result
+from drift_model_lib import drift_model
+
+# matplotlib, pyvisa and paho are imported where they are first used, so
+# scripts that do not plot or do not use a transport do not load them.
 
 
 
 class connection_types(Enum):
     visa = 1
     mqtt = 2
+    simulated = 3
 
 class immersion_scanner:
 
@@ -22,23 +27,110 @@ class immersion_scanner:
     __mqtt_client = None
     __write_topic = "arduino/commands"
     __read_topic = "arduino/prints"
-    buffer = []
 
-    resource_manager = pyvisa.ResourceManager("@py")
+    resource_manager = None
+    __resource_manager_lock = threading.Lock()
     int_per_grame_calibration = -12.72
     water_grames_per_cubic_meter = 1000000
     cubic_meter_calibration = int_per_grame_calibration * water_grames_per_cubic_meter
     steps_per_m = 200/0.00125
 
-    def __init__(self, connection_type, resource_name="Not Visa", mqtt_brocker="not mqtt", mqtt_brocker_port=1883):
+    binary_transfer = False
+    operation_complete_supported = False
+    # The handshake waits for the setup message of the firmware, or for an
+    # answer to *IDN? from firmware already running, in polls of
+    # setup_poll_timeout seconds for up to setup_timeout seconds.
+    setup_poll_timeout = 0.25
+    setup_timeout = 30
+    mqtt_connect_timeout = 5
+    # State of the axis as last commanded, to restore it after reconnecting,
+    # and whether the firmware confirmed that the axis got to axis_position.
+    home_set = False
+    motor_is_on = False
+    axis_position = None
+    axis_in_position = False
+
+    # Upper bounds for the waits, only fully used when the firmware can not
+    # report completion or the buoyancy never settles.
+    command_delay = 0.5
+    motor_on_time = 2
+    motor_off_settle_time = 10
+    axis_home_time = 2
+    # Moves are waited for their distance at axis_speed steps per second,
+    # read from the firmware when it can tell it, plus move_time_margin.
+    # From an unknown position the whole axis_travel is waited for.
+    axis_speed = 4000
+    axis_travel = 32000
+    move_time_margin = 1
+    operation_complete_poll_interval = 0.05
+    settle_averages = 20
+    settle_readings = 5
+    settle_tolerance = 8
+    adaptive_chunk_size = 100
+    # read_to_buffer drains the serial buffer in chunks of up to
+    # bulk_read_chunk_size bytes until the empty line that ends the data.
+    # Without bulk_read every line is read alone, waiting line_read_delay
+    # after each one and a read timeout at the end.
+    bulk_read = True
+    bulk_read_chunk_size = 65536
+    bulk_read_timeout = 5
+    bulk_read_poll_interval = 0.01
+    line_read_delay = 0.5
+    streaming_chunk_size = 10000
+    # Filter parameters, in raw units of the load cell: the deviations from
+    # the average of the successive outlier passes, and the size and the
+    # largest standard deviation of the groups that are averaged.
+    filter_deviations = (400, 70, 40)
+    group_size = 50
+    group_accepted_deviation = 25
+    metrics = None
+    # Commands joined in a single write, see execute_batch.
+    batch_commands = False
+    batch_max_length = 200
+    reply_command_prefixes = ("MEAS:",)
+    # Drift tracking, see scann_object. drift_rate is the drift expected,
+    # in raw units per second, until there are two reference readings.
+    drift_tracking = False
+    drift_reference_averages = 200
+    drift_reference_interval = None
+    drift_rate = 0
+    last_drift_model = None
+
+    def __init__(self, connection_type, resource_name="Not Visa", mqtt_brocker="not mqtt", mqtt_brocker_port=1883, binary_transfer=None, simulated_instrument=None,
+                 mqtt_client_id=None, mqtt_write_topic=None, mqtt_read_topic=None):
+        # Every scanner keeps its own state, so several of them can be used at
+        # the same time. Each MQTT scanner needs its own topics and a client
+        # id not used by other clients of the brocker, a random one by default.
+        self.buffer = []
         if (connection_type == connection_types.visa):
             self.__start_visa_instrument(resource_name)
         elif (connection_type == connection_types.mqtt):
-            self.__start_mqtt_instrument(mqtt_brocker, mqtt_brocker_port)
+            if (mqtt_write_topic != None):
+                self.__write_topic = mqtt_write_topic
+            if (mqtt_read_topic != None):
+                self.__read_topic = mqtt_read_topic
+            if (mqtt_client_id == None):
+                mqtt_client_id = "immersion_scanner_" + uuid.uuid4().hex[:12]
+            self.__start_mqtt_instrument(mqtt_brocker, mqtt_brocker_port, mqtt_client_id)
+        elif (connection_type == connection_types.simulated):
+            self.__start_simulated_instrument(simulated_instrument)
+        else:
+            return
+
+        if (binary_transfer == None):
+            self.negotiate_data_format()
+        else:
+            self.binary_transfer = binary_transfer
+        self.negotiate_operation_complete()
+        self.negotiate_command_batching()
+        self.negotiate_axis_speed()
+        self.__command_queue = []
 
     
     def __del__(self):
-        self.end_instrument()
+        # Scanners created without connection are only used to filter.
+        if (self.__visa_instrument != None or self.__mqtt_client != None):
+            self.end_instrument()
 
 
     def end_instrument(self):
@@ -59,65 +151,357 @@ class immersion_scanner:
 
     def query_command(self, command):
         return self.__query_visa_command(command)
+
+
+    def query_binary_command(self, command):
+        return self.__query_visa_binary_command(command)
+
+
+    def enable_metrics(self, metrics=None):
+        # Keeps timing spans of every command and of every phase of the
+        # layers, and counts the samples rejected by the filters and the
+        # repeated measures, in a scanner_metrics_lib.scan_metrics.
+        if (metrics == None):
+            import scanner_metrics_lib
+            metrics = scanner_metrics_lib.scan_metrics()
+        if (self.metrics == None):
+            self.query_command = self.__get_timed_command(self.query_command)
+            self.query_binary_command = self.__get_timed_command(self.query_binary_command)
+            self.send_command = self.__get_timed_command(self.send_command)
+        self.metrics = metrics
+        return metrics
+
+
+    def __get_timed_command(self, command_function):
+        def timed_command(command, *args):
+            return self.metrics.timed("command", {"command": command.split(" ")[0]}, command_function, command, *args)
+        return timed_command
+
+
+    def negotiate_data_format(self):
+        # Firmware with binary support answers the format query with "INT,32",
+        # older firmware answers with an error or not at all, so ASCII is kept.
+        reply = self.query_command("FORM:DATA INT,32;:FORM:DATA?")
+        self.binary_transfer = reply.strip().upper().startswith("INT")
+        return self.binary_transfer
+
+
+    def negotiate_operation_complete(self):
+        self.operation_complete_supported = self.query_command("*OPC?").strip() == "1"
+        return self.operation_complete_supported
+
+
+    def negotiate_command_batching(self):
+        # Firmware running compound commands answers both queries at once.
+        self.batch_commands = self.query_command("*IDN?;:*IDN?").strip().count(";") == 1
+        return self.batch_commands
+
+
+    def negotiate_axis_speed(self):
+        # Firmware without the speed query keeps the default axis_speed.
+        try:
+            speed = float(self.query_command("OUTP:SPEE?"))
+        except ValueError:
+            return self.axis_speed
+        if (speed > 0):
+            self.axis_speed = speed
+        return self.axis_speed
+
+
+    def is_query(self, command):
+        header = command.strip().lstrip(":").split(" ")[0].upper()
+        return header.endswith("?") or header.startswith(self.reply_command_prefixes)
+
+
+    def execute_batch(self, commands):
+        # Runs the commands with as few writes as possible, joined as
+        # "A;:B;:C". Each write gets a single reply with the replies of its
+        # queries separated by ";", in order. Returns one reply per command,
+        # None for the commands without reply. Binary blocks can not be
+        # split, so binary acquisitions can not be batched.
+        commands = [command.strip().lstrip(":") for command in commands]
+        if (self.binary_transfer and any(command.upper().startswith("MEAS:BUOY:VALS") for command in commands)):
+            raise ValueError("Binary acquisitions can not be batched")
+        if (not self.batch_commands):
+            return [self.__execute_single(command) for command in commands]
+
+        replies = []
+        batch = []
+        for command in commands:
+            if (len(batch) != 0 and len(";:".join(batch + [command])) > self.batch_max_length):
+                replies += self.__execute_joined(batch)
+                batch = []
+            batch.append(command)
+        if (len(batch) != 0):
+            replies += self.__execute_joined(batch)
+        return replies
+
+
+    def queue_command(self, command):
+        # Queued commands are sent together by flush_commands.
+        self.__command_queue.append(command)
+
+
+    def flush_commands(self):
+        commands = self.__command_queue
+        self.__command_queue = []
+        return self.execute_batch(commands)
+
+
+    def __execute_single(self, command):
+        if (self.is_query(command)):
+            return self.query_command(command).strip()
+        self.send_command(command)
+        return None
+
+
+    def __execute_joined(self, commands):
+        queries = [self.is_query(command) for command in commands]
+        if (not any(queries)):
+            self.send_command(";:".join(commands))
+            return [None] * len(commands)
+        reply = self.query_command(";:".join(commands)).strip()
+        query_replies = reply.split(";")
+        if (len(query_replies) != sum(queries)):
+            raise ValueError("Expected " + str(sum(queries)) + " replies for the batch \"" + ";:".join(commands) + "\", received: " + reply)
+        query_replies.reverse()
+        return [query_replies.pop() if query else None for query in queries]
+
+
+    def wait_operation_complete(self, timeout):
+        # *OPC? answers "1" once the firmware has finished the last command
+        # (motion included). Without it the whole timeout is slept.
+        if (not self.operation_complete_supported):
+            time.sleep(timeout)
+            return False
+        start_time = time.time()
+        while (time.time() - start_time < timeout):
+            if (self.query_command("*OPC?").strip() == "1"):
+                return True
+            time.sleep(self.operation_complete_poll_interval)
+        return False
+
+
+    def wait_buoyancy_settle(self, timeout):
+        # Ends when the last settle_readings short averages are within
+        # settle_tolerance raw units of each other.
+        start_time = time.time()
+        readings = deque(maxlen=self.settle_readings)
+        while (time.time() - start_time < timeout):
+            try:
+                readings.append(float(self.query_command("MEAS:BUOY " + str(int(self.settle_averages)))))
+            except ValueError:
+                time.sleep(max(0, timeout - (time.time() - start_time)))
+                return False
+            if (len(readings) == readings.maxlen and max(readings) - min(readings) < self.settle_tolerance):
+                return True
+        return False
     
 
-    def move_to(self, absolute_position, expected_move_time=2):
+    def get_move_time(self, absolute_position=None):
+        # Upper bound for the move from the last position reached.
+        if (absolute_position == None or self.axis_position == None or not self.axis_in_position):
+            distance = self.axis_travel
+        else:
+            distance = abs(int(absolute_position) - self.axis_position)
+        return distance / self.axis_speed + self.move_time_margin
+
+
+    def move_to(self, absolute_position, expected_move_time=None):
+       if (expected_move_time == None):
+           expected_move_time = self.get_move_time(absolute_position)
        self.send_command("OUTP:MOVE " + str(int(absolute_position))) 
-       time.sleep(expected_move_time)
+       self.axis_position = int(absolute_position)
+       self.__wait_move(expected_move_time)
+
+
+    def __wait_move(self, timeout):
+        # Without *OPC? the axis is taken as there after the whole wait.
+        self.axis_in_position = self.wait_operation_complete(timeout) or not self.operation_complete_supported
+        if (not self.axis_in_position):
+            print("The axis did not reach " + str(self.axis_position) + " in " + str(timeout) + " s")
 
     
     def set_axis_home(self):
         self.send_command("CONT:CONF:AXIS:HOME")
-        time.sleep(2)
+        self.home_set = True
+        self.axis_position = 0
+        self.wait_operation_complete(self.axis_home_time)
     
     
     def set_auto_home(self):
+        # The automatic home is only as far as the position when it is the
+        # home in use.
+        move_time = self.get_move_time(None if self.home_set else 0)
         self.send_command("CONT:CONF:AXIS:AUHO")
-        time.sleep(2)
+        self.home_set = False
+        self.axis_position = 0
+        self.__wait_move(self.axis_home_time + move_time)
     
 
     def set_motor_on(self):
         self.send_command("CONT:CONF:MOTR:ON")
-        time.sleep(2)
+        self.motor_is_on = True
+        self.wait_operation_complete(self.motor_on_time)
+
+
+    def set_motor_on_and_move_to(self, absolute_position, expected_move_time=None):
+        # Motor on, move and the first completion query in a single batch.
+        if (expected_move_time == None):
+            expected_move_time = self.get_move_time(absolute_position)
+        commands = ["CONT:CONF:MOTR:ON", "OUTP:MOVE " + str(int(absolute_position))]
+        if (self.operation_complete_supported):
+            commands.append("*OPC?")
+        replies = self.execute_batch(commands)
+        self.motor_is_on = True
+        self.axis_position = int(absolute_position)
+        self.axis_in_position = replies[-1] == "1"
+        if (not self.axis_in_position):
+            self.__wait_move(self.motor_on_time + expected_move_time)
     
     
     def set_motor_off(self):
         self.send_command("CONT:CONF:MOTR:OFF")
-        time.sleep(10)
+        self.motor_is_on = False
+        self.wait_buoyancy_settle(self.motor_off_settle_time)
 
     
     def measure_buoyancy(self, averages=100):
         return float(self.query_command("MEAS:BUOY " + str(int(averages)))) / self.cubic_meter_calibration
     
 
-    def measure_buoyancy_and_filter(self, averages=100):
-        readings_list = []
+    def get_buoyancy_values(self, averages=100):
+        return self.parse_buoyancy_values(self.acquire_buoyancy_values(averages))
+
+
+    def acquire_buoyancy_values(self, averages=100):
+        if (self.binary_transfer):
+            return self.query_binary_command("MEAS:BUOY:VALS " + str(int(averages)))
+        return (self.query_command("MEAS:BUOY:VALS " + str(int(averages))))
+
 
-        # self.read_to_buffer("MEAS:BUOY:VALS " + str(int(averages)))
-        reading = (self.query_command("MEAS:BUOY:VALS " + str(int(averages))))
+    def parse_buoyancy_values(self, reading):
+        if (isinstance(reading, np.ndarray)):
+            return reading
         readings_list = reading.split(",")
         readings_list.pop()
-        for i in range(len(readings_list)):
-            readings_list[i] = int(readings_list[i]) / self.cubic_meter_calibration
-
-        farless_list = self.filter_measures(readings_list, 400 / abs(self.cubic_meter_calibration))
-        farless_list = self.filter_measures(farless_list, 70 / abs(self.cubic_meter_calibration))
-        farless_list = self.filter_measures(farless_list, 40 / abs(self.cubic_meter_calibration))
-        if (averages < 50 and len(farless_list) != 0):
-            average = sum(farless_list)/len(farless_list)
-        else:
-            average = self.get_average_by_filtering_by_deviation(farless_list)
+        return np.array(readings_list, dtype=np.int64)
+
+
+    def measure_buoyancy_and_filter(self, averages=100):
+        readings_array, farless_array, average = self.process_buoyancy_values(self.acquire_buoyancy_values(averages), averages)
 
         if (average != None):
-            return readings_list, farless_list, average
+            return readings_array, farless_array, average
         else:
             print("repeating")
+            self.__count_retry("measure_buoyancy_and_filter")
             return self.measure_buoyancy_and_filter(averages)
 
-    
+
+    def get_readings_array(self, reading):
+        return self.parse_buoyancy_values(reading) / self.cubic_meter_calibration
+
+
+    def process_buoyancy_values(self, reading, averages):
+        readings_array = self.get_readings_array(reading)
+        farless_array, average = self.filter_and_average_readings(readings_array, averages)
+        return readings_array, farless_array, average
+
+
+    def measure_buoyancy_adaptive(self, volume_tolerance, max_averages=10000, time_budget=60):
+        # Takes adaptive_chunk_size samples at a time until the standard
+        # error of the filtered average is below volume_tolerance (m^3), the
+        # time budget is spent or max_averages samples have been taken.
+        # All the samples taken are kept and filtered together. If no group
+        # of samples is accepted by then, the average of the filtered samples
+        # is given as the best estimate.
+        start_time = time.time()
+        readings_chunks = []
+        readings_count = 0
+        while (True):
+            chunk_size = min(self.adaptive_chunk_size, max_averages - readings_count)
+            readings_chunks.append(self.get_buoyancy_values(chunk_size) / self.cubic_meter_calibration)
+            readings_count += len(readings_chunks[-1])
+            readings_array = np.concatenate(readings_chunks)
+
+            farless_array, average = self.filter_and_average_readings(readings_array, readings_count, False)
+            standard_error = self.get_standard_error(farless_array, readings_count)
+
+            if (average != None and standard_error < volume_tolerance):
+                break
+            if (readings_count >= max_averages or time.time() - start_time > time_budget or len(readings_chunks[-1]) == 0):
+                break
+            if (average == None):
+                self.__count_retry("adaptive_chunk")
+
+        # The rejections are counted once, for the readings as finally filtered.
+        if (self.metrics != None):
+            self.filter_and_average_readings(readings_array, readings_count)
+        if (average == None and len(readings_array) != 0):
+            print("No group of samples accepted, using the average of the filtered samples")
+            self.__count_retry("adaptive_best_estimate")
+            estimate_array = farless_array if len(farless_array) != 0 else readings_array
+            average = self.__sequential_sum(estimate_array) / len(estimate_array)
+            standard_error = np.std(estimate_array, ddof=1) / math.sqrt(len(estimate_array)) if len(estimate_array) >= 2 else math.inf
+        return readings_array, farless_array, average, standard_error
+
+
+    def get_streaming_estimator(self):
+        import streaming_filter_lib
+        return streaming_filter_lib.streaming_estimator(self.filter_deviations[-1] / abs(self.cubic_meter_calibration), self.group_size,
+                                                        self.group_accepted_deviation / abs(self.cubic_meter_calibration))
+
+
+    def measure_buoyancy_streaming(self, averages, chunk_size=None):
+        # Takes the samples streaming_chunk_size at a time and filters them
+        # as they arrive, so the memory used does not grow with averages.
+        # Returns the average, its standard error and the samples taken.
+        if (chunk_size == None):
+            chunk_size = self.streaming_chunk_size
+        estimator = self.get_streaming_estimator()
+        while (estimator.count < averages):
+            values = self.get_buoyancy_values(min(chunk_size, averages - estimator.count))
+            if (len(values) == 0):
+                break
+            estimator.add(values / self.cubic_meter_calibration)
+        estimator.finish()
+        if (self.metrics != None):
+            self.metrics.increment("filter_rejected_samples", estimator.rejected_samples, deviation="streaming")
+            self.metrics.increment("deviation_rejected_groups", estimator.rejected_groups)
+        return estimator.get_average(), estimator.get_standard_error(), estimator.count
+
+
+    def filter_and_average_readings(self, readings_array, averages, count_rejections=True):
+        # Array version of the filtering done by filter_measures and
+        # get_average_by_filtering_by_deviation, giving the same averages.
+        # Without count_rejections the rejected samples and groups are not
+        # counted in the metrics, for readings that will be filtered again.
+        farless_array = readings_array
+        for raw_deviation in self.filter_deviations:
+            farless_array = self.__filter_pass(farless_array, raw_deviation, count_rejections)
+        if (averages < self.group_size and len(farless_array) != 0):
+            average = self.__sequential_sum(farless_array) / len(farless_array)
+        else:
+            average = self.get_average_by_filtering_by_deviation_array(farless_array, count_rejections)
+        return farless_array, average
+
+
+    def __filter_pass(self, readings_array, raw_deviation, count_rejections=True):
+        farless_array = self.filter_measures_array(readings_array, raw_deviation / abs(self.cubic_meter_calibration))
+        if (self.metrics != None and count_rejections):
+            self.metrics.increment("filter_rejected_samples", len(readings_array) - len(farless_array), deviation=raw_deviation)
+        return farless_array
+
+
+    def __count_retry(self, source):
+        if (self.metrics != None):
+            self.metrics.increment("measure_retries", source=source)
+
+
     def get_average_by_filtering_by_deviation(self, measures):
-        accepted_standard_deviation = 25 / abs(self.cubic_meter_calibration)
-        groups_size = 50
+        accepted_standard_deviation = self.group_accepted_deviation / abs(self.cubic_meter_calibration)
+        groups_size = self.group_size
         average_acum = 0
         considered_groups = 0
         for i in range(len(measures) // groups_size):
@@ -141,113 +525,843 @@ class immersion_scanner:
             if (abs(reading - average) < accepted_deviation):
                 farless_list.append(reading)
         return farless_list
+
+
+    def filter_measures_array(self, readings_array, accepted_deviation=100):
+        if (len(readings_array) == 0):
+            return readings_array
+        average = self.__sequential_sum(readings_array) / len(readings_array)
+        return readings_array[np.abs(readings_array - average) < accepted_deviation]
+
+
+    def get_average_by_filtering_by_deviation_array(self, measures_array, count_rejections=True):
+        groups_averages = self.get_considered_groups_averages(measures_array)
+        if (self.metrics != None and count_rejections):
+            self.metrics.increment("deviation_rejected_groups", len(measures_array) // self.group_size - len(groups_averages))
+        if (len(groups_averages) == 0):
+            return None
+        return self.__sequential_sum(groups_averages) / len(groups_averages)
+
+
+    def get_considered_groups_averages(self, measures_array):
+        accepted_standard_deviation = self.group_accepted_deviation / abs(self.cubic_meter_calibration)
+        groups_size = self.group_size
+        groups_count = len(measures_array) // groups_size
+        groups = measures_array[:groups_count * groups_size].reshape(groups_count, groups_size)
+        considered = np.std(groups, axis=1) < accepted_standard_deviation
+        return np.cumsum(groups[considered], axis=1)[:, -1] / groups_size
+
+
+    def get_standard_error(self, farless_array, averages):
+        # Standard error of the average given by filter_and_average_readings.
+        # With groups it is taken from the spread of the considered groups
+        # averages, which also accounts for slow oscillations of the liquid.
+        if (averages < self.group_size):
+            if (len(farless_array) < 2):
+                return math.inf
+            return np.std(farless_array, ddof=1) / math.sqrt(len(farless_array))
+        groups_averages = self.get_considered_groups_averages(farless_array)
+        if (len(groups_averages) < 2):
+            return math.inf
+        return np.std(groups_averages, ddof=1) / math.sqrt(len(groups_averages))
+
+
+    @staticmethod
+    def __sequential_sum(values_array):
+        # np.sum uses pairwise summation; the cumulative sum adds in the same
+        # order as the builtin sum, so results match the list code bit by bit.
+        return np.cumsum(values_array)[-1]
     
 
-    def scann_object(self, layer_height, layer_count, averages):
-        layer_height_steps = layer_height * self.steps_per_m
-        measures = []
-        heights = []
+    def scann_object(self, layer_height, layer_count, averages, volume_tolerance=None, time_budget=60, pipelined=False, store_path=None,
+                     layer_callback=None, cancel_event=None, streaming=False):
+        # With volume_tolerance each layer is measured adaptively, taking at
+        # most averages samples. The samples used and the standard error of
+        # each layer are left in last_scan_statistics, and the time spent in
+        # each phase of each layer in last_scan_timings. Returns a scan_result,
+        # that unpacks as the (layer_volumes, heights_m) pair, also left in
+        # last_scan_result with the raw readings of every layer.
+        # With pipelined the samples of a layer are parsed and filtered in a
+        # worker thread while the axis moves to the next layer. Layers whose
+        # samples are rejected are measured again at the end of the scan.
+        # With store_path every layer is appended to a scan_store as soon as
+        # it has been measured, and layer_callback(index, height, average) is
+        # called, from the worker thread in pipelined scans. Setting
+        # cancel_event stops the scan, the layers measured up to that point
+        # are returned. A stored scan that did not end can be continued with
+        # resume_scan.
+        # With streaming the samples are filtered in chunks as they arrive,
+        # for very large averages. The readings are not kept, so the store
+        # only gets the averages.
+        # With drift_tracking the axis goes back to the first layer, whose
+        # volume is known to be the same, to take drift_reference_averages
+        # samples every drift_reference_interval layers and at the end of the
+        # scan. The drift between those references is subtracted from the
+        # layers, so it is not taken as volume, see last_drift_model. The
+        # averages given to layer_callback have the drift estimated so far
+        # subtracted, the store keeps the averages as measured.
+        if (pipelined and volume_tolerance != None):
+            raise ValueError("Adaptive measurements can not be pipelined, each chunk needs the filtered result")
+        if (streaming and (pipelined or volume_tolerance != None)):
+            raise ValueError("Streaming measurements can not be pipelined nor adaptive")
+        if (self.drift_tracking and pipelined):
+            raise ValueError("Drift can not be tracked in pipelined scans, the references need the axis")
+        store = None
+        if (store_path != None):
+            store = scan_store(store_path, {"layer_height": layer_height, "layer_count": layer_count, "averages": averages,
+                                            "volume_tolerance": volume_tolerance, "time_budget": time_budget, "pipelined": pipelined,
+                                            "streaming": streaming, "cubic_meter_calibration": self.cubic_meter_calibration,
+                                            "steps_per_m": self.steps_per_m})
+        self.set_motor_on()
+        self.move_to(0)
+        self.set_axis_home()
+        return self.__scan_layers(store, list(range(layer_count + 1)), [None] * (layer_count + 1), layer_height, averages, volume_tolerance,
+                                  time_budget, pipelined, layer_callback, cancel_event, streaming)
+
+
+    # Continuous scans: samples per acquisition and the delay, in seconds,
+    # between the axis reaching a height and the load cell reading it.
+    continuous_chunk_size = 40
+    continuous_lag = 0.3
+
+    def scann_object_continuous(self, layer_height, layer_count, averages):
+        # Measures while the axis goes down at a constant speed, so there is
+        # no stop nor settle time per layer. The speed is chosen to take
+        # about averages samples per layer. Every sample gets the time it
+        # was taken and, continuous_lag seconds before it, the position of
+        # the axis. The buoyancy at each limit between layers is the line
+        # fitted to the samples up to half a layer around it, rejecting the
+        # samples far from the line as filter_and_average_readings does.
+        # The liquid is let settle before the axis starts, and the samples
+        # taken after the axis has stopped at the bottom are left out, as the
+        # liquid moves again as soon as it stops, before the load cell has
+        # seen the last continuous_lag seconds of the travel.
+        # Returns a scan_result as scann_object, without raw readings, the
+        # samples are left in last_scan_samples as (times, positions in
+        # steps, readings).
         self.set_motor_on()
         self.move_to(0)
         self.set_axis_home()
+        default_speed = self.query_command("OUTP:SPEE?").strip()
+        if (default_speed == ""):
+            raise ValueError("The firmware can not set the speed of the axis")
+        sample_rate = self.measure_sample_rate()
+        layer_steps = layer_height * self.steps_per_m
+        speed = layer_steps * sample_rate / averages
+        total_steps = layer_steps * layer_count
+        self.wait_buoyancy_settle(self.motor_off_settle_time)
+
+        times_chunks = []
+        readings_chunks = []
+        try:
+            self.send_command("OUTP:SPEE %.6f" % speed)
+            start_time = time.perf_counter()
+            self.send_command("OUTP:MOVE " + str(-int(round(total_steps))))
+            self.axis_position = -int(round(total_steps))
+            self.axis_in_position = False
+            end_time = start_time + total_steps / speed + self.continuous_lag + self.continuous_chunk_size / sample_rate
+            while (time.perf_counter() < end_time):
+                readings = self.get_buoyancy_values(self.continuous_chunk_size)
+                # The last sample is taken just before the reply is received.
+                receive_time = time.perf_counter()
+                times_chunks.append(receive_time - np.arange(len(readings) - 1, -1, -1) / sample_rate)
+                readings_chunks.append(readings)
+        finally:
+            self.send_command("OUTP:SPEE " + default_speed)
+            self.send_command("CONT:CONF:MOTR:OFF")
+            self.motor_is_on = False
+
+        times = np.concatenate(times_chunks) - start_time
+        readings = np.concatenate(readings_chunks) / self.cubic_meter_calibration
+        moving = times <= total_steps / speed
+        times = times[moving]
+        readings = readings[moving]
+        positions = np.clip((times - self.continuous_lag) * speed, 0, total_steps)
+        self.last_scan_samples = (times, positions, readings)
+        self.last_drift_model = None
+        result = scan_result([i * layer_height for i in range(layer_count + 1)])
+        result.averages[:] = self.get_continuous_measures(positions, readings, layer_steps, layer_count)
+        self.last_scan_result = result
+        return result
+
+
+    def measure_sample_rate(self, samples=100):
+        # Samples per second of the firmware, without the round trip time.
+        start_time = time.perf_counter()
+        self.query_command("*IDN?")
+        round_trip_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        samples = len(self.get_buoyancy_values(samples))
+        return samples / max(time.perf_counter() - start_time - round_trip_time, 1e-9)
+
+
+    def get_continuous_measures(self, positions, readings, layer_steps, layer_count):
+        # Buoyancy at the limits of the layers, from the robust line fit of
+        # the samples around each of them.
+        deviations = [raw_deviation / abs(self.cubic_meter_calibration) for raw_deviation in self.filter_deviations]
+        order = np.argsort(positions, kind="stable")
+        positions = positions[order]
+        readings = readings[order]
+        measures = np.empty(layer_count + 1)
         for i in range(layer_count + 1):
+            start, end = np.searchsorted(positions, [(i - 0.5) * layer_steps, (i + 0.5) * layer_steps])
+            window_positions = positions[start:end] - i * layer_steps
+            window_readings = readings[start:end]
+            for deviation in deviations:
+                if (len(window_readings) < 2 or np.ptp(window_positions) == 0):
+                    break
+                slope, intercept = np.polyfit(window_positions, window_readings, 1)
+                accepted = np.abs(window_readings - (slope * window_positions + intercept)) < deviation
+                window_positions = window_positions[accepted]
+                window_readings = window_readings[accepted]
+            if (len(window_readings) == 0):
+                raise ValueError("No samples around the limit of layer " + str(i))
+            if (len(window_readings) < 2 or np.ptp(window_positions) == 0):
+                measures[i] = np.mean(window_readings)
+            else:
+                measures[i] = np.polyfit(window_positions, window_readings, 1)[1]
+        return measures
+
+
+    resume_check_averages = 200
+
+    def resume_scan(self, store_path, layer_callback=None, cancel_event=None, check_position=True):
+        # Continues a stored scan with the layers that were not measured,
+        # with the settings kept in its header. The axis is homed again, as
+        # the firmware may have been restarted, and with check_position the
+        # last measured layer is read again to check that the axis and the
+        # object are where they were. Returns the same as scann_object.
+        store = scan_store(store_path)
+        header = store.header
+        if (header.get("adaptive", False)):
+            store.close()
+            raise ValueError("Adaptive scans can not be resumed")
+        if (header["cubic_meter_calibration"] != self.cubic_meter_calibration or header["steps_per_m"] != self.steps_per_m):
+            store.close()
+            raise ValueError("The scan was taken with another calibration")
+        layer_count = header["layer_count"]
+        layer_height = header["layer_height"]
+        measures = [None] * (layer_count + 1)
+        for index in store.get_layer_indexes():
+            if (index <= layer_count):
+                measures[index] = store.layers[index]["average"]
+        layer_indexes = [i for i in range(layer_count + 1) if measures[i] == None]
+        print("Resuming scan with " + str(len(layer_indexes)) + " of " + str(layer_count + 1) + " layers left")
+
+        try:
             self.set_motor_on()
-            self.move_to(i * -layer_height_steps)
-            self.set_motor_off()
-            measures1, measures2, average_new = self.measure_buoyancy_and_filter(averages)
+            self.set_auto_home()
+            self.move_to(0)
+            self.set_axis_home()
+            if (check_position):
+                self.__check_resume_position(store)
+        except:
+            store.close()
+            raise
+        result = self.__scan_layers(store, layer_indexes, measures, layer_height, header["averages"], header["volume_tolerance"],
+                                    header.get("time_budget", 60), header["pipelined"], layer_callback, cancel_event, header.get("streaming", False))
+        for index in store.get_layer_indexes():
+            if (index <= layer_count and index not in layer_indexes):
+                layer = store.layers[index]
+                self.last_scan_statistics[index] = {"samples": layer["samples"], "standard_error": layer["standard_error"]}
+                result.set_layer(index, layer["average"], store.get_raw_readings(index), layer["samples"], layer["standard_error"], layer["timings"])
+        return result
+
+
+    def scann_object_adaptive(self, layer_height, layer_count, averages, min_layer_height=None, refine_tolerance=0.05, max_layers=None,
+                              store_path=None, layer_callback=None, cancel_event=None):
+        # Starts with layer_count layers of layer_height and then measures the
+        # middle of the layers next to the places where the area of the
+        # section changes more than refine_tolerance times the largest area,
+        # and more than the noise, until the layers are min_layer_height
+        # high or max_layers positions have been measured. The layers are
+        # measured as in scann_object, layer_callback gets them in the order
+        # they are measured. Returns a scan_result sorted by height that
+        # unpacks as (layer_volumes, heights, layer_heights), layers being
+        # not equally high.
+        if (min_layer_height == None):
+            min_layer_height = layer_height / 8
+        min_layer_steps = max(1, int(round(min_layer_height * self.steps_per_m)))
+        store = None
+        if (store_path != None):
+            store = scan_store(store_path, {"layer_height": layer_height, "layer_count": layer_count, "averages": averages, "adaptive": True,
+                                            "min_layer_height": min_layer_height, "refine_tolerance": refine_tolerance, "max_layers": max_layers,
+                                            "cubic_meter_calibration": self.cubic_meter_calibration, "steps_per_m": self.steps_per_m})
+        self.last_scan_statistics = []
+        self.last_scan_timings = []
+        self.last_scan_result = None
+        self.last_drift_model = None
+        measures = {}
+        standard_errors = {}
+        raw_readings = []
+        self.set_motor_on()
+        self.move_to(0)
+        self.set_axis_home()
+
+        try:
+            stopped = lambda: (cancel_event != None and cancel_event.is_set()) or (max_layers != None and len(measures) >= max_layers)
+            pending_heights = [int(round(i * layer_height * self.steps_per_m)) for i in range(layer_count + 1)]
+            while (len(pending_heights) != 0 and not stopped()):
+                for height in pending_heights:
+                    if (stopped()):
+                        break
+                    index = len(self.last_scan_timings)
+                    self.last_scan_statistics.append(None)
+                    self.last_scan_timings.append({})
+                    measures1, measures2, average_new, standard_error = self.__measure_layer(-height, averages, None, 60, self.last_scan_timings[index])
+                    raw_readings.append(self.__finish_layer(store, layer_callback, index, height, -height, measures1, measures2, average_new,
+                                                            standard_error, self.last_scan_timings[index]))
+                    measures[height] = average_new
+                    standard_errors[height] = standard_error
+                pending_heights = self.__get_refinement_heights(measures, standard_errors, min_layer_steps, refine_tolerance)
+        finally:
+            if (store != None):
+                store.close()
+
+        # Heights are measured in order, so they match the statistics.
+        heights = list(measures)
+        result = scan_result.from_layers(np.array(heights) / self.steps_per_m, [measures[height] for height in heights], raw_readings,
+                                         [statistics["samples"] for statistics in self.last_scan_statistics], [standard_errors[height] for height in heights],
+                                         self.last_scan_timings, ("layer_volumes", "heights_m", "layer_heights"))
+        self.last_scan_result = result
+        return result
+
+
+    @staticmethod
+    def __get_refinement_heights(measures, standard_errors, min_layer_steps, refine_tolerance):
+        # The area of each layer is compared with the area of the next one.
+        heights = np.array(sorted(measures))
+        if (len(heights) < 3):
+            return []
+        averages = np.array([measures[height] for height in heights])
+        errors = np.array([standard_errors[height] for height in heights], dtype=np.float64)
+        # Layers with less than two groups have no standard error.
+        finite_errors = errors[np.isfinite(errors)]
+        errors[~np.isfinite(errors)] = np.max(finite_errors) if len(finite_errors) != 0 else 0
+        layer_steps = np.diff(heights)
+        areas = np.diff(averages) / layer_steps
+        areas_noise = np.sqrt(errors[:-1] ** 2 + errors[1:] ** 2) / layer_steps
+        thresholds = np.maximum(refine_tolerance * np.max(np.abs(areas)), 3 * np.sqrt(areas_noise[:-1] ** 2 + areas_noise[1:] ** 2))
+        sharp_changes = np.flatnonzero(np.abs(np.diff(areas)) > thresholds)
+        layers = np.union1d(sharp_changes, sharp_changes + 1)
+        layers = layers[layer_steps[layers] >= 2 * min_layer_steps]
+        return [int(height) for height in (heights[layers] + layer_steps[layers] // 2)]
+
+
+    def __check_resume_position(self, store):
+        # The tolerance is half the volume of a layer, a reading taken one
+        # layer away is off by a whole layer.
+        indexes = store.get_layer_indexes()
+        if (len(indexes) < 2):
+            return
+        last_layer = store.layers[indexes[-1]]
+        averages = store.get_averages()
+        tolerance = abs(np.mean(np.diff(averages))) / 2
+        self.set_motor_on()
+        self.move_to(last_layer["position"])
+        if (not self.axis_in_position):
+            raise ValueError("Position check failed: the axis did not reach layer " + str(last_layer["index"]))
+        self.set_motor_off()
+        reading = self.measure_buoyancy_and_filter(self.resume_check_averages)[2]
+        if (abs(reading - last_layer["average"]) > tolerance):
+            raise ValueError("Position check failed: layer " + str(last_layer["index"]) + " reads " + str(reading) +
+                             " instead of " + str(last_layer["average"]))
+
+
+    def __scan_layers(self, store, layer_indexes, measures, layer_height, averages, volume_tolerance, time_budget, pipelined, layer_callback,
+                      cancel_event, streaming):
+        # Measures the layers in layer_indexes, measures has the averages of
+        # the layers already measured.
+        layer_height_steps = layer_height * self.steps_per_m
+        positions = [i * -layer_height_steps for i in range(len(measures))]
+        heights = [i * layer_height_steps for i in range(len(measures))]
+        self.last_scan_statistics = [None] * len(measures)
+        self.last_scan_timings = [{} for i in range(len(measures))]
+        # Streaming layers keep no readings.
+        result = scan_result([height / self.steps_per_m for height in heights], 0 if streaming else int(averages))
+        for i, measure in enumerate(measures):
+            if (measure != None):
+                result.averages[i] = measure
+        self.last_scan_result = result
+        # Resumed scans have no first layer to compare with.
+        drift = None
+        if (self.drift_tracking and not pipelined and len(layer_indexes) != 0 and layer_indexes[0] == 0):
+            drift = drift_model(self.drift_rate / self.cubic_meter_calibration)
+        self.last_drift_model = drift
+
+        try:
+            if (pipelined):
+                processed_layers = []
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    for i in layer_indexes:
+                        if (cancel_event != None and cancel_event.is_set()):
+                            break
+                        reading = self.__call_profiled(i, self.__acquire_layer, positions[i], averages, self.last_scan_timings[i])
+                        processed_layers.append((i, executor.submit(self.__call_profiled, i, self.__process_and_finish_layer, reading, averages, store,
+                                                                    layer_callback, i, heights[i], positions[i], self.last_scan_timings[i])))
+                    start_time = time.perf_counter()
+                    processed_layers = [(i, processed_layer.result()) for i, processed_layer in processed_layers]
+                    self.last_scan_timings[-1]["wait"] = time.perf_counter() - start_time
+
+                for i, (measures1, measures2, average_new, standard_error) in processed_layers:
+                    if (average_new == None):
+                        if (cancel_event != None and cancel_event.is_set()):
+                            break
+                        print("repeating")
+                        self.__count_retry("pipelined_layer")
+                        measures1, measures2, average_new, standard_error = self.__measure_layer(positions[i], averages, volume_tolerance, time_budget, self.last_scan_timings[i])
+                        self.__finish_layer(store, layer_callback, i, heights[i], positions[i], measures1, measures2, average_new, standard_error, self.last_scan_timings[i])
+                    measures[i] = average_new
+            else:
+                for i in layer_indexes:
+                    if (cancel_event != None and cancel_event.is_set()):
+                        break
+                    if (streaming):
+                        average_new, standard_error, samples = self.__call_profiled(i, self.__measure_layer_streaming, positions[i], averages, self.last_scan_timings[i])
+                        measures1, measures2 = np.empty(0), np.empty(0)
+                    else:
+                        measures1, measures2, average_new, standard_error = self.__call_profiled(i, self.__measure_layer, positions[i], averages, volume_tolerance,
+                                                                                                 time_budget, self.last_scan_timings[i])
+                        samples = len(measures1)
+                    self.__finish_layer(store, layer_callback, i, heights[i], positions[i], measures1, measures2, average_new, standard_error, self.last_scan_timings[i],
+                                        samples)
+                    measures[i] = average_new
+                    if (drift != None and i == 0):
+                        drift.add_reference(result.times[0], average_new)
+                    elif (drift != None and self.drift_reference_interval != None and i % self.drift_reference_interval == 0 and i != layer_indexes[-1]):
+                        self.__timed(self.last_scan_timings[i], "reference", self.__measure_drift_reference, drift)
+                if (drift != None and not (cancel_event != None and cancel_event.is_set())):
+                    self.__timed(self.last_scan_timings[-1], "reference", self.__measure_drift_reference, drift)
+        finally:
+            # Every measured layer is already on disk if the scan fails.
+            if (store != None):
+                store.close()
+
+        for i, timings in enumerate(self.last_scan_timings):
+            result.set_timings(i, timings)
+        if (drift != None):
+            measured_count = result.measured_count
+            result.baselines[:measured_count] = drift.get_baseline(result.times[:measured_count])
+        return result
+
+
+    def __measure_drift_reference(self, drift):
+        # __position_layer raises rather than leaving the axis away from the
+        # first layer, a reading taken there would be taken as drift.
+        self.__position_layer(0, {})
+        average = self.measure_buoyancy_and_filter(self.drift_reference_averages)[2]
+        drift.add_reference(time.perf_counter(), average)
+
+
+    def __position_layer(self, position, timings):
+        # A move not finished in time is waited for once more, over the whole
+        # travel, before the motor is turned off, as that stops the axis.
+        if (self.batch_commands):
+            self.__timed(timings, "move", self.set_motor_on_and_move_to, position)
+        else:
+            self.__timed(timings, "motor_on", self.set_motor_on)
+            self.__timed(timings, "move", self.move_to, position)
+        if (not self.axis_in_position):
+            self.__count_retry("move")
+            self.__timed(timings, "move", self.move_to, position)
+        if (not self.axis_in_position):
+            raise ValueError("The axis did not reach position " + str(int(position)) + ", the layer is not measured")
+        self.__timed(timings, "motor_off", self.set_motor_off)
+
+
+    def __acquire_layer(self, position, averages, timings):
+        self.__position_layer(position, timings)
+        return self.__timed(timings, "acquire", self.acquire_buoyancy_values, averages)
+
+
+    def __process_layer(self, reading, averages, timings):
+        measures1 = self.__timed(timings, "parse", self.get_readings_array, reading)
+        measures2, average_new = self.__timed(timings, "filter", self.filter_and_average_readings, measures1, averages)
+        standard_error = self.__timed(timings, "filter", self.get_standard_error, measures2, averages)
+        if (average_new != None):
             print(average_new)
-            measures.append(average_new)
-            heights.append(i * layer_height_steps)
-        layer_volumes = []
-        for i in range(1, len(measures)):
-            layer_volumes.append(measures[i] - measures[i - 1])
-        heights_m = [i / self.steps_per_m for i in heights[0:len(heights) - 1]]
-        return (layer_volumes, heights_m)
+        return measures1, measures2, average_new, standard_error
+
+
+    def __process_and_finish_layer(self, reading, averages, store, layer_callback, index, height, position, timings):
+        measures1, measures2, average_new, standard_error = self.__process_layer(reading, averages, timings)
+        if (average_new != None):
+            self.__finish_layer(store, layer_callback, index, height, position, measures1, measures2, average_new, standard_error, timings)
+        return measures1, measures2, average_new, standard_error
+
+
+    def __finish_layer(self, store, layer_callback, index, height, position, measures1, measures2, average_new, standard_error, timings, samples=None):
+        # Returns the raw readings of the layer, also kept in last_scan_result
+        # when there is one, adaptive scans build theirs at the end.
+        if (samples == None):
+            samples = len(measures1)
+        self.last_scan_statistics[index] = {"samples": samples, "standard_error": standard_error}
+        raw_readings = np.rint(measures1 * self.cubic_meter_calibration).astype(scan_result.raw_dtype)
+        now = time.perf_counter()
+        if (self.last_scan_result != None):
+            self.last_scan_result.set_layer(index, average_new, raw_readings, samples, standard_error)
+            self.last_scan_result.times[index] = now
+        if (store != None):
+            store.append_layer(index, height / self.steps_per_m, position, average_new, raw_readings, measures2,
+                               samples=samples, standard_error=float(standard_error), timings=timings)
+        if (layer_callback != None):
+            if (self.last_drift_model != None):
+                average_new = average_new - float(self.last_drift_model.get_baseline(now))
+            layer_callback(index, height / self.steps_per_m, average_new)
+        return raw_readings
+
+
+    def __measure_layer(self, position, averages, volume_tolerance, time_budget, timings):
+        if (volume_tolerance != None):
+            self.__position_layer(position, timings)
+            measures1, measures2, average_new, standard_error = self.__timed(timings, "acquire", self.measure_buoyancy_adaptive, volume_tolerance, averages, time_budget)
+            if (average_new == None):
+                raise ValueError("No samples received for the layer at position " + str(position))
+            return measures1, measures2, average_new, standard_error
+
+        reading = self.__acquire_layer(position, averages, timings)
+        measures1, measures2, average_new, standard_error = self.__process_layer(reading, averages, timings)
+        while (average_new == None):
+            print("repeating")
+            self.__count_retry("layer")
+            reading = self.__timed(timings, "acquire", self.acquire_buoyancy_values, averages)
+            measures1, measures2, average_new, standard_error = self.__process_layer(reading, averages, timings)
+        return measures1, measures2, average_new, standard_error
+
+
+    def __measure_layer_streaming(self, position, averages, timings):
+        self.__position_layer(position, timings)
+        average_new, standard_error, samples = self.__timed(timings, "acquire", self.measure_buoyancy_streaming, averages)
+        while (average_new == None):
+            print("repeating")
+            self.__count_retry("streaming_layer")
+            average_new, standard_error, samples = self.__timed(timings, "acquire", self.measure_buoyancy_streaming, averages)
+        print(average_new)
+        return average_new, standard_error, samples
+
+
+    def __timed(self, timings, phase, function, *args):
+        start_time = time.perf_counter()
+        result = function(*args)
+        duration = time.perf_counter() - start_time
+        timings[phase] = timings.get(phase, 0) + duration
+        if (self.metrics != None):
+            self.metrics.add_span("layer_phase", duration, phase=phase)
+        return result
+
+
+    def __call_profiled(self, index, function, *args):
+        if (self.metrics != None and self.metrics.profile_layer == index):
+            return self.metrics.profile(function, *args)
+        return function(*args)
     
 
     @staticmethod
-    def plot_scaned_object(measures, heights):
+    def plot_scaned_object(measures, heights, layer_heights=None):
+        from matplotlib import pyplot as plt
         fig = plt.figure()
-        ax = fig.add_subplot(111, projection='3d')
-        radiuses = [math.sqrt(abs(measure / ((heights[1] - heights[0]) * math.pi))) for measure in measures]
-        for radius, height in zip(radiuses, heights):
-            Xc,Yc,Zc = immersion_scanner.__get_cilinder_plot_data(height, radius, abs(heights[1] - heights[0]))
-            ax.plot_surface(Xc, Yc, Zc, alpha=0.5)
-
+        immersion_scanner.add_subplot_to_fig_from_measures(fig, measures, heights, layer_heights=layer_heights)
         plt.show()
     
     @staticmethod
-    def plot_scaned_object_2(radiuses, heights):
+    def plot_scaned_object_2(radiuses, heights, layer_heights=None):
+        from matplotlib import pyplot as plt
         fig = plt.figure()
         ax = fig.add_subplot(111, projection='3d')
-        for radius, height in zip(radiuses, heights):
-            Xc,Yc,Zc = immersion_scanner.__get_cilinder_plot_data(height, radius, abs(heights[1] - heights[0]))
-            ax.plot_surface(Xc, Yc, Zc, alpha=0.5)
-
+        immersion_scanner.add_cilinders_to_axes(ax, radiuses, heights, immersion_scanner.get_layer_heights(heights, layer_heights))
         plt.show()
     
 
     @staticmethod
-    def get_plot_data_from_measures(measures, heights):
-        radiuses = [math.sqrt(abs(measure / ((heights[1] - heights[0]) * math.pi))) for measure in measures]
+    def get_layer_heights(heights, layer_heights=None):
+        # Height of every layer, heights being their bottoms. Scans with
+        # equal layers only give the heights, the last layer is then as high
+        # as the previous one.
+        if (layer_heights is not None):
+            return np.broadcast_to(np.asarray(layer_heights, dtype=np.float64), (len(heights),))
+        if (len(heights) < 2):
+            raise ValueError("The layer height is needed when there is only one layer")
+        differences = np.abs(np.diff(np.asarray(heights, dtype=np.float64)))
+        return np.append(differences, differences[-1])
+
+
+    @staticmethod
+    def get_radiuses(layer_volumes, layer_heights):
+        # Radius of the cylinder with the volume and the height of each
+        # layer. layer_heights can be a single height or one per layer.
+        return np.sqrt(np.abs(np.asarray(layer_volumes, dtype=np.float64) / (np.asarray(layer_heights, dtype=np.float64) * np.pi)))
+
+
+    @staticmethod
+    def get_plot_data_from_measures(measures, heights, layer_heights=None):
+        layer_heights = immersion_scanner.get_layer_heights(heights, layer_heights)
+        radiuses = list(immersion_scanner.get_radiuses(measures, layer_heights))
         surfaces = []
         print("radiuses")
         print(radiuses)
         print("heights")
         print(heights)
-        for radius, height in zip(radiuses, heights):
-            Xc,Yc, Zc = immersion_scanner.__get_cilinder_plot_data(height, radius, abs(heights[1] - heights[0]))
+        for radius, height, layer_height in zip(radiuses, heights, layer_heights):
+            Xc,Yc, Zc = immersion_scanner.__get_cilinder_plot_data(height, radius, layer_height)
             surfaces.append((Xc, Yc, Zc))
         return surfaces
     
     
     @staticmethod
-    def add_subplot_to_fig_from_measures(fig, measures, heights):
+    def add_subplot_to_fig_from_measures(fig, measures, heights, angular_resolution=None, layer_heights=None):
         ax = fig.add_subplot(111, projection="3d")
-        surfaces = immersion_scanner.get_plot_data_from_measures(measures, heights)
-        layer_height = abs(heights[1] - heights[0])
-        for (Xc, Yc, Zc), height in zip(surfaces, heights):
-            alpha_val = 0.5
-            color_val = "red"
-            ax.plot_surface(Xc, Yc, Zc, alpha=alpha_val, color=color_val)
-            p = Circle((0, 0), Xc[0][0], alpha=alpha_val, color=color_val)
-            ax.add_patch(p)
-            art3d.pathpatch_2d_to_3d(p, z=height, zdir="z")
-            p = Circle((0, 0), Xc[0][0], alpha=alpha_val, color=color_val)
-            ax.add_patch(p)
-            art3d.pathpatch_2d_to_3d(p, z=(height + layer_height), zdir="z")
+        layer_heights = immersion_scanner.get_layer_heights(heights, layer_heights)
+        radiuses = immersion_scanner.get_radiuses(measures, layer_heights)
+        immersion_scanner.add_cilinders_to_axes(ax, radiuses, heights, layer_heights, angular_resolution)
         return ax
 
 
+    plot_angular_resolution = 50
+    plot_minimum_angular_resolution = 12
+    plot_max_polygons = 30000
+
+    @staticmethod
+    def get_plot_angular_resolution(layer_count):
+        # Each layer is drawn with three polygons per angle (side and caps), the
+        # number of angles is lowered as layers are added to keep it drawable.
+        resolution = immersion_scanner.plot_max_polygons // (3 * max(1, layer_count))
+        return int(max(immersion_scanner.plot_minimum_angular_resolution, min(immersion_scanner.plot_angular_resolution, resolution)))
+
+
+    @staticmethod
+    def add_cilinders_to_axes(ax, radiuses, heights, layer_height, angular_resolution=None, color="red", alpha=0.5):
+        # All the layers, caps included, go in a single Poly3DCollection.
+        # layer_height can be a single height or one per layer.
+        from mpl_toolkits.mplot3d import art3d
+        if (angular_resolution == None):
+            angular_resolution = immersion_scanner.get_plot_angular_resolution(len(radiuses))
+        polygons = immersion_scanner.get_cilinders_polygons(radiuses, heights, layer_height, angular_resolution)
+        collection = art3d.Poly3DCollection(polygons, facecolor=color, alpha=alpha, linewidths=0)
+        ax.add_collection3d(collection)
+
+        max_radius = max(float(np.max(radiuses)) if len(radiuses) != 0 else 0, 1e-9)
+        ax.set_xlim(-max_radius, max_radius)
+        ax.set_ylim(-max_radius, max_radius)
+        ax.set_zlim(float(np.min(heights)), float(np.max(np.asarray(heights) + layer_height)))
+        return collection
+
+
+    @staticmethod
+    def get_cilinders_polygons(radiuses, heights, layer_height, angular_resolution=50):
+        # Returns an array of shape (layers * 3 * segments, 4, 3) with one side
+        # quad and two cap quads, closed at the axis, per angular segment.
+        cos_table, sin_table = immersion_scanner.__get_trig_tables(angular_resolution)
+        radiuses = np.asarray(radiuses, dtype=np.float64)[:, None, None]
+        bottoms = np.asarray(heights, dtype=np.float64)[:, None, None]
+        layer_height = np.broadcast_to(np.asarray(layer_height, dtype=np.float64), (len(bottoms),))[:, None, None]
+        segments = np.arange(angular_resolution - 1)
+        ring = np.stack((segments, segments + 1, segments + 1, segments), axis=1)
+
+        side_x = radiuses * cos_table[ring]
+        side_y = radiuses * sin_table[ring]
+        side_z = bottoms + np.array([0, 0, 1, 1]) * layer_height
+        cap_ring = np.stack((segments, segments, segments + 1, segments + 1), axis=1)
+        cap_scale = np.array([0, 1, 1, 0])
+        cap_x = radiuses * cos_table[cap_ring] * cap_scale
+        cap_y = radiuses * sin_table[cap_ring] * cap_scale
+        side_z = np.broadcast_to(side_z, side_x.shape)
+
+        polygons = np.concatenate((
+            np.stack((side_x, side_y, side_z), axis=-1),
+            np.stack((cap_x, cap_y, np.broadcast_to(bottoms, cap_x.shape)), axis=-1),
+            np.stack((cap_x, cap_y, np.broadcast_to(bottoms + layer_height, cap_x.shape)), axis=-1)), axis=1)
+        return polygons.reshape(-1, 4, 3)
+
+
+    __trig_tables = {}
+
+    @staticmethod
+    def __get_trig_tables(angular_resolution):
+        if (angular_resolution not in immersion_scanner.__trig_tables):
+            theta = np.linspace(0, 2*np.pi, angular_resolution)
+            immersion_scanner.__trig_tables[angular_resolution] = (np.cos(theta), np.sin(theta))
+        return immersion_scanner.__trig_tables[angular_resolution]
+
+
+    @classmethod
+    def get_resource_manager(cls):
+        # Created on the first use and shared by all the scanners.
+        with cls.__resource_manager_lock:
+            if (cls.resource_manager == None):
+                import pyvisa
+                cls.resource_manager = pyvisa.ResourceManager("@py")
+            return cls.resource_manager
+
+
     def get_id(self):
         return self.query_command("*IDN?")
 
 
+    def set_calibration(self, int_per_grame_calibration=None, steps_per_m=None, drift_rate=None):
+        if (int_per_grame_calibration != None):
+            self.int_per_grame_calibration = int_per_grame_calibration
+            self.cubic_meter_calibration = int_per_grame_calibration * self.water_grames_per_cubic_meter
+        if (steps_per_m != None):
+            self.steps_per_m = steps_per_m
+        if (drift_rate != None):
+            self.drift_rate = drift_rate
+
+
+    def load_calibration_profile(self, profiles_path):
+        # Takes the calibration of this device from a calibration_profiles
+        # file, a device without a profile keeps its calibration.
+        from calibration_profile_lib import calibration_profiles
+        device_id = self.get_id().strip()
+        profile = calibration_profiles(profiles_path).get(device_id)
+        if (profile == None):
+            print("No calibration profile for " + device_id)
+            return None
+        self.set_calibration(profile.get("int_per_grame_calibration"), profile.get("steps_per_m"), profile.get("drift_rate"))
+        return profile
+
+
+    def save_calibration_profile(self, profiles_path):
+        # The drift rate is the one measured in the last scan, when it had
+        # two references.
+        from calibration_profile_lib import calibration_profiles
+        if (self.last_drift_model != None and len(self.last_drift_model.reference_times) >= 2):
+            self.drift_rate = self.last_drift_model.rate * self.cubic_meter_calibration
+        profiles = calibration_profiles(profiles_path)
+        profile = profiles.set(self.get_id().strip(), int_per_grame_calibration=self.int_per_grame_calibration, steps_per_m=self.steps_per_m,
+                               drift_rate=self.drift_rate)
+        profiles.save()
+        return profile
+
+
+    def reconnect(self):
+        # Opens the transport again, keeping the capabilities negotiated and
+        # the transport methods, so wrappers like the ones of enable_metrics
+        # stay. Returns True when the firmware has been restarted, its state
+        # is then lost, see restore_state.
+        if (self.__mqtt_client != None):
+            return self.__reconnect_mqtt_instrument()
+        if (self.__visa_instrument == None):
+            raise ValueError("The scanner has no transport to reconnect")
+        try:
+            self.__visa_instrument.close()
+        except Exception as e:
+            print("Closing the lost instrument failed: " + str(e))
+        self.__visa_instrument = self.__open_visa_resource()
+        self.__visa_instrument.timeout = None
+        return self.__wait_instrument_setup()
+
+
+    def restore_state(self, firmware_restarted=True):
+        # Sets again the data format, the home, the position and the motor
+        # state after the firmware has been restarted, the home being the
+        # automatic home as in resume_scan. Otherwise only the position and
+        # the motor state are sent again, in case a command was lost. The
+        # axis may have been stopped anywhere, so the move back is waited for
+        # over the whole travel.
+        home_set, motor_is_on, axis_position = self.home_set, self.motor_is_on, self.axis_position
+        if (firmware_restarted):
+            if (self.binary_transfer):
+                self.send_command("FORM:DATA INT,32")
+            if (axis_position != None):
+                self.set_motor_on()
+                self.set_auto_home()
+                if (home_set):
+                    self.set_axis_home()
+        if (axis_position != None):
+            self.set_motor_on()
+            self.move_to(axis_position, self.get_move_time())
+            if (not self.axis_in_position):
+                raise ValueError("The axis did not reach " + str(axis_position) + " again")
+        if (not motor_is_on and axis_position != None):
+            self.set_motor_off()
+
+
     def __start_visa_instrument(self, resource_name):
-        self.__visa_instrument = self.resource_manager.open_resource(resource_name)
+        self.__open_visa_resource = lambda: self.get_resource_manager().open_resource(resource_name)
+        self.__setup_visa_instrument(self.__open_visa_resource())
+
+
+    def __start_simulated_instrument(self, simulated_instrument):
+        # The simulator behaves as a pyvisa resource, so the visa methods are used.
+        if (simulated_instrument == None):
+            import scanner_simulator_lib
+            simulated_instrument = scanner_simulator_lib.simulated_instrument()
+        self.__open_visa_resource = simulated_instrument.open
+        self.__setup_visa_instrument(simulated_instrument)
+
+
+    def __setup_visa_instrument(self, visa_instrument):
+        self.__visa_instrument = visa_instrument
         self.__visa_instrument.timeout = None
 
         self.query_command = self.__query_visa_command
+        self.query_binary_command = self.__query_visa_binary_command
         self.send_command = self.__send_visa_command
         self.read_command = self.__read_visa_command
         self.end_instrument = self.__end_visa_instrument
         self.read_to_buffer = self.__read_visa_to_buffer
+        self.__wait_instrument_setup()
+
 
-        while not self.read_command().startswith("Instrument setup"):
-            print("Waiting for instrument setup...")
-            time.sleep(1)
+    def __wait_instrument_setup(self):
+        # Returns True when the setup message was received, False when the
+        # firmware was already running. Anything still arriving after it is
+        # discarded, so no late line is taken as a reply.
+        start_time = time.time()
+        firmware_restarted = None
+        while (firmware_restarted == None):
+            if (time.time() - start_time > self.setup_timeout):
+                raise ValueError("The instrument did not finish its setup in " + str(self.setup_timeout) + " s")
+            reading = self.__read_visa_line(self.setup_poll_timeout)
+            if (reading.startswith("Instrument setup")):
+                firmware_restarted = True
+            elif (reading == ""):
+                self.__visa_instrument.write("*IDN?")
+                if (self.__read_visa_line(self.setup_poll_timeout) != ""):
+                    firmware_restarted = False
+                else:
+                    print("Waiting for instrument setup...")
+        while (self.__read_visa_line(self.setup_poll_timeout) != ""):
+            pass
         print("Instrument setup complete")
+        return firmware_restarted
+
+
+    def __read_visa_line(self, timeout):
+        self.__visa_instrument.timeout = timeout * 1000
+        try:
+            return self.__visa_instrument.read()
+        except Exception:
+            return ""
+        finally:
+            self.__visa_instrument.timeout = None
 
     
-    def __start_mqtt_instrument(self, mqtt_brocker, mqtt_brocker_port):
-        self.__mqtt_client = mqtt.Client("vscode")
-        self.__mqtt_client.connect(mqtt_brocker, mqtt_brocker_port) 
-        self.__mqtt_client.loop_start()
-        self.__mqtt_client.subscribe(self.__read_topic)
+    def __start_mqtt_instrument(self, mqtt_brocker, mqtt_brocker_port, mqtt_client_id):
+        self.__mqtt_condition = threading.Condition()
+        self.__mqtt_correlation_ids = itertools.count(1)
+        self.__mqtt_waiting_ids = []
+        self.__mqtt_replies = {}
+        self.__mqtt_unrequested_messages = deque(maxlen=100)
+        self.__mqtt_buffering = False
+
+        self.__mqtt_connected = False
+
+        import paho.mqtt.client as mqtt
+        self.__mqtt_client = mqtt.Client(mqtt_client_id, protocol=mqtt.MQTTv5)
         self.__mqtt_client.on_message = self.__on_mqtt_message
+        self.__mqtt_client.on_connect = self.__on_mqtt_connect
+        self.__mqtt_client.on_disconnect = self.__on_mqtt_disconnect
+        self.__mqtt_client.connect(mqtt_brocker, int(mqtt_brocker_port))
+        self.__mqtt_client.loop_start()
+        with self.__mqtt_condition:
+            if (not self.__mqtt_condition.wait_for(lambda: self.__mqtt_connected, self.mqtt_connect_timeout)):
+                self.__mqtt_client.loop_stop()
+                raise ValueError("Could not connect to the mqtt brocker " + str(mqtt_brocker) + ":" + str(mqtt_brocker_port))
 
         self.end_instrument = self.__end_mqtt_instrument
         self.query_command = self.__query_mqtt_command
+        self.query_binary_command = self.__query_mqtt_binary_command
         self.send_command = self.__send_mqtt_command
         self.read_command = self.__read_mqtt_command
         self.read_to_buffer = self.__read_mqtt_to_buffer
@@ -257,11 +1371,15 @@ class immersion_scanner:
         if (command != ""):
             self.send_command(command)
 
+        # Only serial resources know how many bytes are waiting.
+        if (self.bulk_read and hasattr(self.__visa_instrument, "bytes_in_buffer")):
+            return self.__read_visa_bulk_to_buffer()
+
         self.buffer = []
         current_reading = self.__read_visa_command()
         while current_reading != "":
             self.buffer.append(current_reading[:-2])
-            time.sleep(0.5)
+            time.sleep(self.line_read_delay)
             current_reading = self.__read_visa_command()
         if (self.buffer[-1] == ""):
             self.buffer.pop()
@@ -270,27 +1388,46 @@ class immersion_scanner:
             return False
 
 
-    def __read_mqtt_to_buffer(self, command=""):
+    def __read_visa_bulk_to_buffer(self):
+        # Returns False if no data arrives for bulk_read_timeout seconds
+        # before the empty line.
         self.buffer = []
+        pending = b""
+        last_data_time = time.time()
+        while (time.time() - last_data_time < self.bulk_read_timeout):
+            available = self.__visa_instrument.bytes_in_buffer
+            if (available == 0):
+                time.sleep(self.bulk_read_poll_interval)
+                continue
+            lines = (pending + self.__visa_instrument.read_bytes(min(available, self.bulk_read_chunk_size))).split(b"\n")
+            last_data_time = time.time()
+            pending = lines.pop()
+            for i in range(len(lines)):
+                line = lines[i].rstrip(b"\r").decode("utf-8", errors="replace")
+                if (line == ""):
+                    if (i != len(lines) - 1 or pending != b""):
+                        print("Data after the end of the buffer discarded")
+                    return True
+                self.buffer.append(line)
+        return False
 
-        self.__mqtt_client.on_message = self.__on_mqtt_message_to_buffer
+
+    def __read_mqtt_to_buffer(self, command=""):
+        with self.__mqtt_condition:
+            self.buffer = []
+            self.__mqtt_buffering = True
 
         if (command != ""):
             self.send_command(command)
 
-        start_time = time.time()
-        while (len(self.buffer) == 0 and (time.time() - start_time) < 2):
-            pass
+        with self.__mqtt_condition:
+            if (self.__mqtt_condition.wait_for(lambda: len(self.buffer) != 0, 2)):
+                self.__mqtt_condition.wait_for(lambda: self.buffer[-1] == "", 30)
+            self.__mqtt_buffering = False
 
         if (len(self.buffer) == 0):
             return False
 
-        start_time = time.time()
-        while (self.buffer[-1] != "" and (time.time() - start_time) < 30):
-            pass
-
-        self.__mqtt_client.on_message = self.__on_mqtt_message
-
         if (self.buffer[-1] == ""):
             self.buffer.pop()
             return True
@@ -302,6 +1439,38 @@ class immersion_scanner:
         return
 
 
+    def __on_mqtt_connect(self, client, userdata, *connect_result):
+        # Also called when paho connects again by itself, the subscription is
+        # made every time as the brocker may have forgotten it.
+        client.subscribe(self.__read_topic)
+        with self.__mqtt_condition:
+            self.__mqtt_connected = True
+            self.__mqtt_condition.notify_all()
+
+
+    def __on_mqtt_disconnect(self, client, userdata, *disconnect_result):
+        with self.__mqtt_condition:
+            self.__mqtt_connected = False
+            self.__mqtt_condition.notify_all()
+
+
+    def __reconnect_mqtt_instrument(self):
+        # The firmware is behind the brocker, so its restarts are not seen,
+        # only that it answers again. Replies of the lost requests are dropped.
+        with self.__mqtt_condition:
+            connected = self.__mqtt_connected
+            self.__mqtt_waiting_ids.clear()
+            self.__mqtt_replies.clear()
+        if (not connected):
+            self.__mqtt_client.reconnect()
+        with self.__mqtt_condition:
+            if (not self.__mqtt_condition.wait_for(lambda: self.__mqtt_connected, self.mqtt_connect_timeout)):
+                raise ConnectionError("Could not connect to the mqtt brocker again")
+        if (self.__query_mqtt_command("*IDN?").strip() == ""):
+            raise ConnectionError("The scanner does not answer through the mqtt brocker")
+        return False
+
+
     def __end_visa_instrument(self):
         if (self.__visa_instrument == None):
             raise ValueError("Visa instrument method used in a non visa scanner. __visa_instrument was None")
@@ -322,27 +1491,98 @@ class immersion_scanner:
             printString = ""
             self.__visa_instrument.timeout = None
         return printString
+
+
+    def __query_visa_binary_command(self, command):
+        if (self.__visa_instrument == None):
+            raise ValueError("Visa instrument method used in a non visa scanner. __visa_instrument was None")
+        self.__visa_instrument.write(command)
+        header = self.__visa_instrument.read_bytes(2)
+        if (header[0:1] != b"#" or not header[1:2].isdigit() or header[1:2] == b"0"):
+            # An error line instead of the block, the rest of it is dropped.
+            reply = header.decode("utf-8", errors="replace")
+            if (not reply.endswith("\n")):
+                reply += self.__read_visa_line(self.bulk_read_timeout)
+            raise ValueError("Binary block does not start with '#' for " + command + ", received: " + reply.strip())
+        length_digits = int(header[1:2])
+        length = int(self.__visa_instrument.read_bytes(length_digits))
+        data = self.__visa_instrument.read_bytes(length)
+        self.__visa_instrument.read()
+        return np.frombuffer(data, dtype=self.binary_block_dtype)
+
+
+    binary_block_dtype = np.dtype("<i4")
+
+    @staticmethod
+    def decode_binary_block(block):
+        # IEEE-488.2 definite length block: "#", digits count, byte count, data.
+        if (block[0:1] != b"#"):
+            raise ValueError("Binary block does not start with '#'")
+        length_digits = int(block[1:2])
+        length = int(block[2:2 + length_digits])
+        return np.frombuffer(block, dtype=immersion_scanner.binary_block_dtype,
+                             count=length // immersion_scanner.binary_block_dtype.itemsize, offset=2 + length_digits)
         
     
 
-    __return_mqtt_string = None
-
     def __on_mqtt_message(self, client, userdata, message):
-        self.__return_mqtt_string = str(message.payload.decode("utf-8"))
+        correlation_id = self.__get_mqtt_correlation_id(message)
+        with self.__mqtt_condition:
+            if (self.__mqtt_buffering):
+                self.buffer.append(str(message.payload.decode("utf-8", errors="replace")))
+            elif (correlation_id in self.__mqtt_waiting_ids):
+                self.__mqtt_replies[correlation_id] = message
+            elif (correlation_id == None and len(self.__mqtt_waiting_ids) != 0):
+                # Firmware without correlation data answers in order, so the
+                # reply belongs to the oldest request still waiting.
+                self.__mqtt_replies[self.__mqtt_waiting_ids.pop(0)] = message
+            elif (correlation_id == None):
+                self.__mqtt_unrequested_messages.append(message)
+            self.__mqtt_condition.notify_all()
 
-    
-    def __on_mqtt_message_to_buffer(self, client, userdata, message):
-        self.buffer.append(str(message.payload.decode("utf-8")))
+
+    @staticmethod
+    def __get_mqtt_correlation_id(message):
+        correlation_data = getattr(getattr(message, "properties", None), "CorrelationData", None)
+        if (correlation_data == None):
+            return None
+        try:
+            return int(correlation_data)
+        except ValueError:
+            return None
+
+
+    def __request_mqtt_reply(self, command, timeout=5):
+        from paho.mqtt.packettypes import PacketTypes
+        from paho.mqtt.properties import Properties
+        with self.__mqtt_condition:
+            correlation_id = next(self.__mqtt_correlation_ids)
+            self.__mqtt_waiting_ids.append(correlation_id)
+
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.CorrelationData = str(correlation_id).encode()
+        properties.ResponseTopic = self.__read_topic
+        self.__mqtt_client.publish(self.__write_topic, command, properties=properties)
+
+        with self.__mqtt_condition:
+            self.__mqtt_condition.wait_for(lambda: correlation_id in self.__mqtt_replies, timeout)
+            if (correlation_id in self.__mqtt_waiting_ids):
+                self.__mqtt_waiting_ids.remove(correlation_id)
+            return self.__mqtt_replies.pop(correlation_id, None)
 
 
     def __query_mqtt_command(self, command):
-        self.__mqtt_client.publish(self.__write_topic, command)
-        self.__return_mqtt_string = None
-        start_time = time.time()
-        while (time.time() - start_time < 5):
-            if (self.__return_mqtt_string != None):
-                return (self.__return_mqtt_string)
-        return ("")
+        message = self.__request_mqtt_reply(command)
+        if (message == None):
+            return ("")
+        return str(message.payload.decode("utf-8", errors="replace"))
+
+
+    def __query_mqtt_binary_command(self, command):
+        message = self.__request_mqtt_reply(command)
+        if (message == None):
+            return np.array([], dtype=self.binary_block_dtype)
+        return self.decode_binary_block(message.payload)
     
 
     def __send_visa_command(self, command):
@@ -350,7 +1590,8 @@ class immersion_scanner:
             raise ValueError("Visa instrument method used in a non visa scanner. __visa_instrument was None")
         
         self.__visa_instrument.write(command)
-        time.sleep(0.5)
+        if (not self.operation_complete_supported):
+            time.sleep(self.command_delay)
 
     
     def __send_mqtt_command(self, command):
@@ -375,20 +1616,19 @@ class immersion_scanner:
 
 
     def __read_mqtt_command(self):
-        start_time = time.time()
-        prev_return_mqtt_string = self.__return_mqtt_string
-        while (prev_return_mqtt_string == self.__return_mqtt_string):
-            if (time.time() - start_time > 5):
+        with self.__mqtt_condition:
+            if (not self.__mqtt_condition.wait_for(lambda: len(self.__mqtt_unrequested_messages) != 0, 5)):
                 return ("")
-        return self.__return_mqtt_string
+            message = self.__mqtt_unrequested_messages.popleft()
+        return str(message.payload.decode("utf-8", errors="replace"))
 
 
     @staticmethod
     def __get_cilinder_plot_data(center_z, radius, height):
         z = np.linspace(center_z, center_z + height, 2)
-        theta = np.linspace(0, 2*np.pi, 50)
-        theta_grid, z_grid=np.meshgrid(theta, z)
-        x_grid = radius*np.cos(theta_grid)
-        y_grid = radius*np.sin(theta_grid)
+        cos_table, sin_table = immersion_scanner.__get_trig_tables(50)
+        x_grid = radius*np.tile(cos_table, (2, 1))
+        y_grid = radius*np.tile(sin_table, (2, 1))
+        z_grid = np.repeat(z[:, None], 50, axis=1)
         return x_grid,y_grid,z_grid
 
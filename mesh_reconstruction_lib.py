@@ -0,0 +1,249 @@
+import numpy as np
+from immersion_scanner_lib import immersion_scanner
+
+
+class revolution_mesh:
+    # Closed triangle mesh of a body of revolution around the z axis. The
+    # profile is a list of (height, radius) points from the bottom to the
+    # top, every point becomes a ring of angular_resolution vertices and the
+    # bottom and the top rings are closed with a fan around a center vertex,
+    # so the mesh is watertight and its normals point outwards.
+
+    stl_dtype = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])
+    ply_vertex_dtype = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4")])
+    ply_face_dtype = np.dtype([("count", "u1"), ("indices", "<i4", (3,))])
+
+    def __init__(self, profile_heights, profile_radiuses, angular_resolution=100):
+        self.profile_heights = np.asarray(profile_heights, dtype=np.float64)
+        self.profile_radiuses = np.asarray(profile_radiuses, dtype=np.float64)
+        if (len(self.profile_heights) < 2 or len(self.profile_heights) != len(self.profile_radiuses)):
+            raise ValueError("The profile needs at least two points with a height and a radius each")
+        self.angular_resolution = int(angular_resolution)
+        if (self.angular_resolution < 3):
+            raise ValueError("The angular resolution must be at least 3")
+        self.vertices = self.__get_vertices()
+        self.__faces = None
+
+
+    @property
+    def faces(self):
+        # Indices of the vertices of every triangle, only made when used, the
+        # STL export goes through the rings.
+        if (self.__faces is None):
+            self.__faces = self.__get_faces()
+        return self.__faces
+
+
+    @property
+    def faces_count(self):
+        return 2 * self.angular_resolution * len(self.profile_heights)
+
+
+    @staticmethod
+    def from_scan(layer_volumes, heights, layer_heights=None, angular_resolution=100, smoothing=0, samples_per_layer=1, interpolation="step"):
+        # layer_volumes and heights are the result of scann_object, heights
+        # being the bottom of each layer. See from_scan_result.
+        profile_heights, profile_radiuses = revolution_mesh.get_profile(layer_volumes, heights, layer_heights, smoothing, samples_per_layer, interpolation)
+        return revolution_mesh(profile_heights, profile_radiuses, angular_resolution)
+
+
+    @staticmethod
+    def from_scan_result(result, angular_resolution=100, smoothing=0, samples_per_layer=1, interpolation="step"):
+        return revolution_mesh.from_scan(result.layer_volumes, result.heights_m, result.layer_heights, angular_resolution, smoothing,
+                                         samples_per_layer, interpolation)
+
+
+    @staticmethod
+    def get_profile(layer_volumes, heights, layer_heights=None, smoothing=0, samples_per_layer=1, interpolation="step"):
+        # With "step" every layer is a cylinder, as in the plots, and keeps its
+        # measured volume. With "linear" the radiuses are taken at the middle
+        # of the layers and joined with straight lines, sampled
+        # samples_per_layer times per layer. smoothing is the standard
+        # deviation, in layers, of a gaussian applied to the radiuses.
+        heights = np.asarray(heights, dtype=np.float64)
+        layer_heights = immersion_scanner.get_layer_heights(heights, layer_heights)
+        radiuses = revolution_mesh.smooth(immersion_scanner.get_radiuses(layer_volumes, layer_heights), smoothing)
+        tops = heights + layer_heights
+
+        if (interpolation == "step"):
+            profile_heights = np.linspace(heights, tops, samples_per_layer + 1, axis=1).ravel()
+            profile_radiuses = np.repeat(radiuses, samples_per_layer + 1)
+        elif (interpolation == "linear"):
+            profile_heights = np.linspace(heights[0], tops[-1], len(heights) * samples_per_layer + 1)
+            profile_radiuses = np.interp(profile_heights, (heights + tops) / 2, radiuses)
+        else:
+            raise ValueError("Unknown interpolation: " + str(interpolation))
+        return profile_heights, profile_radiuses
+
+
+    @staticmethod
+    def smooth(radiuses, smoothing):
+        radiuses = np.asarray(radiuses, dtype=np.float64)
+        if (smoothing <= 0 or len(radiuses) < 2):
+            return radiuses
+        half_width = int(np.ceil(3 * smoothing))
+        kernel = np.exp(-0.5 * (np.arange(-half_width, half_width + 1) / smoothing) ** 2)
+        padded = np.pad(radiuses, half_width, mode="edge")
+        return np.convolve(padded, kernel / np.sum(kernel), mode="valid")
+
+
+    def get_triangles(self, dtype=np.float64):
+        # Same as taking the vertices of the faces, copied a ring at a time
+        # instead of gathered one by one.
+        resolution = self.angular_resolution
+        triangles = np.empty((self.faces_count, 3, 3), dtype=dtype)
+        rings, next_rings = self.__get_rings(dtype)
+        self.__fill_fan_triangles(triangles[:resolution], triangles[-resolution:], rings, next_rings)
+        self.__fill_side_triangles(triangles[resolution:-resolution].reshape(len(rings) - 1, resolution, 2, 3, 3), rings, next_rings, 0, len(rings) - 1)
+        return triangles
+
+
+    def get_normals(self):
+        resolution = self.angular_resolution
+        normals = np.empty((self.faces_count, 3))
+        normals[:resolution] = (0, 0, -1)
+        normals[resolution:-resolution].reshape(-1, resolution, 2, 3)[:] = self.__get_side_normals(0, len(self.profile_heights) - 1)[:, :, None]
+        normals[-resolution:] = (0, 0, 1)
+        return normals
+
+
+    def get_volume(self):
+        triangles = self.get_triangles()
+        return np.sum(np.einsum("ij,ij->i", triangles[:, 0], np.cross(triangles[:, 1], triangles[:, 2]))) / 6
+
+
+    # Faces of the sides written to the STL at a time, few enough for the
+    # records to stay in the cache.
+    stl_chunk_faces = 32768
+
+    def write_stl(self, path, header="immersion scanner revolution mesh"):
+        # The records are filled and written a few rings at a time, so no
+        # array as large as the file is made.
+        resolution = self.angular_resolution
+        rings, next_rings = self.__get_rings(np.float32)
+        steps_count = len(rings) - 1
+        chunk_steps = max(1, self.stl_chunk_faces // (2 * resolution))
+        records = np.empty((min(chunk_steps, steps_count), resolution, 2), dtype=self.stl_dtype)
+        records["attribute"] = 0
+        fans = np.zeros(2 * resolution, dtype=self.stl_dtype)
+        fans["normal"][:resolution] = (0, 0, -1)
+        fans["normal"][resolution:] = (0, 0, 1)
+        self.__fill_fan_triangles(fans["vertices"][:resolution], fans["vertices"][resolution:], rings, next_rings)
+        with open(path, "wb") as file:
+            file.write(header.encode()[:80].ljust(80, b" "))
+            file.write(np.array([self.faces_count], dtype="<u4").tobytes())
+            fans[:resolution].tofile(file)
+            for start in range(0, steps_count, chunk_steps):
+                end = min(start + chunk_steps, steps_count)
+                chunk = records[:end - start]
+                chunk["normal"] = self.__get_side_normals(start, end)[:, :, None]
+                self.__fill_side_triangles(chunk["vertices"], rings, next_rings, start, end)
+                chunk.tofile(file)
+            fans[resolution:].tofile(file)
+
+
+    def write_ply(self, path):
+        vertices = np.empty(len(self.vertices), dtype=self.ply_vertex_dtype)
+        vertices["x"] = self.vertices[:, 0]
+        vertices["y"] = self.vertices[:, 1]
+        vertices["z"] = self.vertices[:, 2]
+        faces = np.empty(len(self.faces), dtype=self.ply_face_dtype)
+        faces["count"] = 3
+        faces["indices"] = self.faces
+        header = ("ply\nformat binary_little_endian 1.0\n"
+                  "element vertex " + str(len(vertices)) + "\nproperty float x\nproperty float y\nproperty float z\n"
+                  "element face " + str(len(faces)) + "\nproperty list uchar int vertex_indices\nend_header\n")
+        with open(path, "wb") as file:
+            file.write(header.encode("ascii"))
+            vertices.tofile(file)
+            faces.tofile(file)
+
+
+    def __get_rings(self, dtype):
+        # The vertices of every ring, and of the next segment of every ring.
+        rings = self.vertices[:-2].astype(dtype).reshape(-1, self.angular_resolution, 3)
+        return rings, np.roll(rings, -1, axis=1)
+
+
+    def __get_side_normals(self, start, end):
+        # The two triangles between two rings form a flat trapezoid, so the
+        # normal only depends on the step of the profile and on the angle of
+        # the middle of the segment, there is no need for cross products.
+        # One normal per segment of the steps from start to end.
+        half_segment = np.pi / self.angular_resolution
+        middle_angles = np.arange(self.angular_resolution) * (2 * half_segment) + half_segment
+        height_steps = np.diff(self.profile_heights[start:end + 1])[:, None]
+        radius_steps = (np.diff(self.profile_radiuses[start:end + 1]) * np.cos(half_segment))[:, None]
+        lengths = np.sqrt(height_steps ** 2 + radius_steps ** 2)
+        # Steps with no height nor radius change have no area.
+        lengths[lengths == 0] = np.inf
+
+        normals = np.empty((len(height_steps), self.angular_resolution, 3))
+        normals[:, :, 0] = height_steps / lengths * np.cos(middle_angles)
+        normals[:, :, 1] = height_steps / lengths * np.sin(middle_angles)
+        normals[:, :, 2] = -radius_steps / lengths
+        return normals
+
+
+    def __fill_side_triangles(self, triangles, rings, next_rings, start, end):
+        # triangles has the (a, b, c) and (a, c, d) triangles of every segment
+        # of the steps from start to end, as in __get_faces.
+        triangles[:, :, 0, 0] = rings[start:end]
+        triangles[:, :, 0, 1] = next_rings[start:end]
+        triangles[:, :, 0, 2] = next_rings[start + 1:end + 1]
+        triangles[:, :, 1, 0] = rings[start:end]
+        triangles[:, :, 1, 1] = next_rings[start + 1:end + 1]
+        triangles[:, :, 1, 2] = rings[start + 1:end + 1]
+
+
+    def __fill_fan_triangles(self, bottom, top, rings, next_rings):
+        bottom[:, 0] = (0, 0, self.profile_heights[0])
+        bottom[:, 1] = next_rings[0]
+        bottom[:, 2] = rings[0]
+        top[:, 0] = (0, 0, self.profile_heights[-1])
+        top[:, 1] = rings[-1]
+        top[:, 2] = next_rings[-1]
+
+
+    def __get_vertices(self):
+        theta = np.arange(self.angular_resolution) * (2 * np.pi / self.angular_resolution)
+        rings_count = len(self.profile_heights)
+        vertices = np.empty((rings_count * self.angular_resolution + 2, 3))
+        vertices[:-2, 0] = (self.profile_radiuses[:, None] * np.cos(theta)).ravel()
+        vertices[:-2, 1] = (self.profile_radiuses[:, None] * np.sin(theta)).ravel()
+        vertices[:-2, 2] = np.repeat(self.profile_heights, self.angular_resolution)
+        vertices[-2] = (0, 0, self.profile_heights[0])
+        vertices[-1] = (0, 0, self.profile_heights[-1])
+        return vertices
+
+
+    def __get_faces(self):
+        resolution = self.angular_resolution
+        rings_count = len(self.profile_heights)
+        segments = np.arange(resolution)
+        next_segments = (segments + 1) % resolution
+        ring_starts = np.arange(rings_count - 1)[:, None] * resolution
+
+        a = (ring_starts + segments).astype(np.int32)
+        b = (ring_starts + next_segments).astype(np.int32)
+
+        # Bottom fan, the (a, b, c) and (a, c, d) triangles of every segment
+        # and top fan, written in place.
+        faces = np.empty((2 * resolution * rings_count, 3), dtype=np.int32)
+        sides = faces[resolution:-resolution].reshape(rings_count - 1, resolution, 2, 3)
+        sides[:, :, 0, 0] = a
+        sides[:, :, 0, 1] = b
+        sides[:, :, 0, 2] = b + resolution
+        sides[:, :, 1, 0] = a
+        sides[:, :, 1, 1] = b + resolution
+        sides[:, :, 1, 2] = a + resolution
+
+        bottom_center = rings_count * resolution
+        top_start = (rings_count - 1) * resolution
+        faces[:resolution, 0] = bottom_center
+        faces[:resolution, 1] = next_segments
+        faces[:resolution, 2] = segments
+        faces[-resolution:, 0] = bottom_center + 1
+        faces[-resolution:, 1] = top_start + segments
+        faces[-resolution:, 2] = top_start + next_segments
+        return faces
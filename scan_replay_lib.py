@@ -0,0 +1,107 @@
+import itertools
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from immersion_scanner_lib import immersion_scanner
+from scan_storage_lib import scan_store
+
+
+class scan_replay:
+    # Filters again the raw readings kept in a scan_store, with the filter
+    # of the scanner and any filter parameters, so the filter can be tuned
+    # on recorded scans instead of scanning the objects again. With the
+    # parameters of the scan the stored averages are given back exactly.
+    # Layers of streaming scans have no raw readings and give None.
+
+    filter_parameters = ("filter_deviations", "group_size", "group_accepted_deviation")
+
+    def __init__(self, store_path):
+        self.store_path = str(store_path)
+        self.store = scan_store(store_path)
+        self.cubic_meter_calibration = self.store.header.get("cubic_meter_calibration", immersion_scanner.cubic_meter_calibration)
+        self.layer_indexes = sorted(self.store.get_layer_indexes(), key=lambda index: self.store.layers[index]["height"])
+
+
+    def replay(self, metrics=None, **parameters):
+        # parameters are filter_parameters of immersion_scanner. With metrics
+        # the rejected samples and groups are counted in that scan_metrics.
+        scanner = self.get_filter_scanner(parameters)
+        scanner.metrics = metrics
+        averages = []
+        standard_errors = []
+        rejected_samples = []
+        for index in self.layer_indexes:
+            readings_array = self.store.get_raw_readings(index) / scanner.cubic_meter_calibration
+            if (len(readings_array) == 0):
+                averages.append(None)
+                standard_errors.append(math.inf)
+                rejected_samples.append(0)
+                continue
+            farless_array, average = scanner.filter_and_average_readings(readings_array, len(readings_array))
+            averages.append(average)
+            standard_errors.append(float(scanner.get_standard_error(farless_array, len(readings_array))))
+            rejected_samples.append(len(readings_array) - len(farless_array))
+
+        heights = [self.store.layers[index]["height"] for index in self.layer_indexes]
+        layer_volumes = None
+        if (None not in averages):
+            layer_volumes = list(np.diff(averages))
+        return {"parameters": parameters, "layer_volumes": layer_volumes, "heights": heights[:-1], "averages": averages,
+                "standard_errors": standard_errors, "rejected_samples": rejected_samples,
+                "stored_averages": [self.store.layers[index]["average"] for index in self.layer_indexes]}
+
+
+    def get_filter_scanner(self, parameters):
+        # A scanner without connection, only used to filter.
+        scanner = immersion_scanner(None)
+        scanner.cubic_meter_calibration = self.cubic_meter_calibration
+        for name, value in parameters.items():
+            if (name not in self.filter_parameters):
+                raise ValueError("Unknown filter parameter: " + str(name))
+            setattr(scanner, name, value)
+        if (len(scanner.filter_deviations) == 0 or int(scanner.group_size) < 1):
+            raise ValueError("The filter needs at least one deviation and groups of at least one sample")
+        scanner.filter_deviations = tuple(scanner.filter_deviations)
+        scanner.group_size = int(scanner.group_size)
+        return scanner
+
+
+    @staticmethod
+    def get_parameter_grid(parameter_values):
+        # {"group_size": [25, 50], ...} gives every combination of the values.
+        names = list(parameter_values)
+        return [dict(zip(names, values)) for values in itertools.product(*(parameter_values[name] for name in names))]
+
+
+    @staticmethod
+    def sweep(store_paths, parameter_grid, max_workers=None, chunk_size=None):
+        # Replays every store with every parameter set of the grid in a
+        # process pool. Each task opens a store once and replays chunk_size
+        # parameter sets. Results are in store, then grid order, with the
+        # store path added.
+        store_paths = [str(store_path) for store_path in store_paths]
+        parameter_grid = list(parameter_grid)
+        if (max_workers == None):
+            max_workers = os.cpu_count() or 1
+        if (chunk_size == None):
+            chunk_size = max(1, math.ceil(len(parameter_grid) * len(store_paths) / max_workers / 4))
+        tasks = [(store_path, parameter_grid[start:start + chunk_size]) for store_path in store_paths
+                 for start in range(0, len(parameter_grid), chunk_size)]
+        if (max_workers == 1 or len(tasks) == 0):
+            return [result for task in tasks for result in replay_store(*task)]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return [result for results in executor.map(replay_store, *zip(*tasks)) for result in results]
+
+
+def replay_store(store_path, parameter_grid):
+    # Task of scan_replay.sweep, at module level so it can be sent to the
+    # worker processes.
+    replay = scan_replay(store_path)
+    results = []
+    for parameters in parameter_grid:
+        result = replay.replay(**parameters)
+        result["store_path"] = store_path
+        results.append(result)
+    replay.store.close()
+    return results
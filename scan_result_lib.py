@@ -0,0 +1,132 @@
+import numpy as np
+
+
+class scan_result:
+    # Result of a scan kept in NumPy arrays, one item per measured position
+    # from the bottom of the object up: the filtered buoyancy average, the
+    # height in m, the samples taken, the standard error and the time spent
+    # in each phase, and the baseline drift subtracted from the average at
+    # the time the layer was measured. The raw readings of all the layers share one int32
+    # buffer, each layer being the slice given by raw_offsets and
+    # raw_counts, in a space of raw_capacities samples. Positions not
+    # measured have a NaN average, only the ones up to the first of them are
+    # part of the result. It unpacks as
+    # unpack_fields, the (layer_volumes, heights_m) pair by default, so it
+    # can be used where the tuple returned by scann_object was.
+
+    __slots__ = ("averages", "heights", "samples", "standard_errors", "timings", "times", "baselines", "raw_readings", "raw_offsets", "raw_counts",
+                 "raw_capacities", "unpack_fields")
+    timing_phases = ("motor_on", "move", "motor_off", "acquire", "parse", "filter", "wait", "reference")
+    raw_dtype = np.dtype("<i4")
+
+    def __init__(self, heights, samples_per_layer=0, unpack_fields=("layer_volumes", "heights_m")):
+        # The raw buffer is preallocated with samples_per_layer samples for
+        # each position, layers with more samples are added at its end.
+        self.heights = np.asarray(heights, dtype=np.float64)
+        positions_count = len(self.heights)
+        self.averages = np.full(positions_count, np.nan)
+        self.samples = np.zeros(positions_count, dtype=np.int64)
+        self.standard_errors = np.full(positions_count, np.inf)
+        self.timings = np.zeros((positions_count, len(self.timing_phases)))
+        self.times = np.zeros(positions_count)
+        self.baselines = np.zeros(positions_count)
+        self.raw_readings = np.zeros(positions_count * samples_per_layer, dtype=self.raw_dtype)
+        self.raw_offsets = np.arange(positions_count, dtype=np.int64) * samples_per_layer
+        self.raw_counts = np.zeros(positions_count, dtype=np.int64)
+        self.raw_capacities = np.full(positions_count, samples_per_layer, dtype=np.int64)
+        self.unpack_fields = tuple(unpack_fields)
+
+
+    @staticmethod
+    def from_layers(heights, averages, raw_readings, samples, standard_errors, timings, unpack_fields=("layer_volumes", "heights_m")):
+        # Result of layers measured in any order, sorted by height.
+        order = np.argsort(np.asarray(heights, dtype=np.float64), kind="stable")
+        result = scan_result(np.asarray(heights, dtype=np.float64)[order], 0, unpack_fields)
+        result.averages[:] = np.asarray(averages, dtype=np.float64)[order]
+        result.samples[:] = np.asarray(samples, dtype=np.int64)[order]
+        result.standard_errors[:] = np.asarray(standard_errors, dtype=np.float64)[order]
+        for i, index in enumerate(order):
+            result.set_timings(i, timings[index])
+        raw_counts = np.array([len(raw_readings[index]) for index in order], dtype=np.int64)
+        result.raw_counts[:] = raw_counts
+        result.raw_capacities[:] = raw_counts
+        result.raw_offsets[:] = np.cumsum(raw_counts) - raw_counts
+        if (len(order) != 0):
+            result.raw_readings = np.concatenate([np.asarray(raw_readings[index], dtype=result.raw_dtype) for index in order])
+        return result
+
+
+    def set_layer(self, index, average, raw_readings=None, samples=None, standard_error=np.inf, timings=None):
+        if (raw_readings is not None):
+            self.set_raw_readings(index, raw_readings)
+        if (samples == None):
+            samples = self.raw_counts[index]
+        self.averages[index] = average
+        self.samples[index] = samples
+        self.standard_errors[index] = standard_error
+        if (timings != None):
+            self.set_timings(index, timings)
+
+
+    def set_raw_readings(self, index, raw_readings):
+        raw_readings = np.asarray(raw_readings)
+        if (len(raw_readings) > self.raw_capacities[index]):
+            self.raw_offsets[index] = len(self.raw_readings)
+            self.raw_capacities[index] = len(raw_readings)
+            self.raw_readings = np.concatenate((self.raw_readings, np.zeros(len(raw_readings), dtype=self.raw_dtype)))
+        offset = self.raw_offsets[index]
+        self.raw_readings[offset:offset + len(raw_readings)] = raw_readings
+        self.raw_counts[index] = len(raw_readings)
+
+
+    def set_timings(self, index, timings):
+        for phase, duration in timings.items():
+            if (phase in self.timing_phases):
+                self.timings[index, self.timing_phases.index(phase)] = duration
+
+
+    def get_raw_readings(self, index):
+        return self.raw_readings[self.raw_offsets[index]:self.raw_offsets[index] + self.raw_counts[index]]
+
+
+    def get_timings(self, phase):
+        return self.timings[:self.measured_count, self.timing_phases.index(phase)]
+
+
+    @property
+    def measured_count(self):
+        unmeasured = np.flatnonzero(np.isnan(self.averages))
+        return int(unmeasured[0]) if len(unmeasured) != 0 else len(self.averages)
+
+
+    @property
+    def layer_volumes(self):
+        measured_count = self.measured_count
+        return np.diff(self.averages[:measured_count] - self.baselines[:measured_count])
+
+
+    @property
+    def heights_m(self):
+        return self.heights[:max(self.measured_count - 1, 0)]
+
+
+    @property
+    def layer_heights(self):
+        return np.diff(self.heights[:self.measured_count])
+
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.__slots__ if isinstance(getattr(self, name), np.ndarray))
+
+
+    def __iter__(self):
+        return iter([getattr(self, field) for field in self.unpack_fields])
+
+
+    def __len__(self):
+        return len(self.unpack_fields)
+
+
+    def __getitem__(self, index):
+        return getattr(self, self.unpack_fields[index])
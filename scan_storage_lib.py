@@ -0,0 +1,178 @@
+import json
+import time
+from pathlib import Path
+import numpy as np
+from scan_result_lib import scan_result
+
+
+class scan_store:
+    # A scan is a directory with a small JSON header, one JSON line per
+    # measured layer and two append only binary files with the raw and the
+    # filtered readings of every layer, one after the other. The layer lines
+    # keep the offsets, so the binary files can be memory mapped on reload.
+    # Readings past the last layer line, left by a crash, are ignored and
+    # cut from the files before the next layer is appended.
+
+    header_file_name = "header.json"
+    layers_file_name = "layers.jsonl"
+    raw_file_name = "raw_readings.bin"
+    filtered_file_name = "filtered_readings.bin"
+    raw_dtype = np.dtype("<i4")
+    filtered_dtype = np.dtype("<f8")
+    format_version = 1
+
+    def __init__(self, path, header=None):
+        self.path = Path(path)
+        self.__raw_file = None
+        self.__filtered_file = None
+        self.__layers_file = None
+        self.__raw_map = None
+        self.__filtered_map = None
+        self.layers = {}
+        self.__raw_count = 0
+        self.__filtered_count = 0
+
+        if (header != None):
+            self.path.mkdir(parents=True, exist_ok=False)
+            self.header = dict(header)
+            self.header["format_version"] = self.format_version
+            self.header["created"] = time.time()
+            self.header["raw_dtype"] = self.raw_dtype.str
+            self.header["filtered_dtype"] = self.filtered_dtype.str
+            with open(self.path / self.header_file_name, "w") as file:
+                json.dump(self.header, file, indent=4)
+        else:
+            with open(self.path / self.header_file_name, "r") as file:
+                self.header = json.load(file)
+            if (self.header.get("format_version") != self.format_version):
+                raise ValueError("Unsupported scan format version: " + str(self.header.get("format_version")))
+            self.__load_layers()
+
+
+    def __del__(self):
+        self.close()
+
+
+    def close(self):
+        for file in (self.__raw_file, self.__filtered_file, self.__layers_file):
+            if (file != None):
+                file.close()
+        self.__raw_file = None
+        self.__filtered_file = None
+        self.__layers_file = None
+
+
+    def append_layer(self, index, height, position, average, raw_readings, filtered_readings, **layer_data):
+        # Binary data is written first, so a layer line is never left pointing
+        # to readings that did not reach the disk.
+        if (self.__layers_file == None):
+            self.__raw_file = open(self.path / self.raw_file_name, "ab")
+            self.__filtered_file = open(self.path / self.filtered_file_name, "ab")
+            self.__raw_file.truncate(self.__raw_count * self.raw_dtype.itemsize)
+            self.__filtered_file.truncate(self.__filtered_count * self.filtered_dtype.itemsize)
+            self.__layers_file = open(self.path / self.layers_file_name, "a")
+            if (self.__layers_file.tell() != 0 and not (self.path / self.layers_file_name).read_text().endswith("\n")):
+                self.__layers_file.write("\n")
+
+        raw_readings = np.ascontiguousarray(raw_readings, dtype=self.raw_dtype)
+        filtered_readings = np.ascontiguousarray(filtered_readings, dtype=self.filtered_dtype)
+        self.__raw_file.write(raw_readings.data)
+        self.__filtered_file.write(filtered_readings.data)
+        self.__raw_file.flush()
+        self.__filtered_file.flush()
+
+        layer = dict(layer_data)
+        layer.update({"index": int(index), "height": float(height), "position": float(position),
+                      "average": float(average), "time": time.time(),
+                      "raw_offset": self.__raw_count, "raw_count": len(raw_readings),
+                      "filtered_offset": self.__filtered_count, "filtered_count": len(filtered_readings)})
+        self.__layers_file.write(json.dumps(layer) + "\n")
+        self.__layers_file.flush()
+
+        self.__raw_count += len(raw_readings)
+        self.__filtered_count += len(filtered_readings)
+        self.layers[layer["index"]] = layer
+        return layer
+
+
+    def get_layer_indexes(self):
+        return sorted(self.layers)
+
+
+    def get_raw_readings(self, index):
+        layer = self.layers[index]
+        if (self.__raw_map is None or len(self.__raw_map) < layer["raw_offset"] + layer["raw_count"]):
+            self.__raw_map = self.__map_file(self.raw_file_name, self.raw_dtype, self.__raw_count)
+        return self.__raw_map[layer["raw_offset"]:layer["raw_offset"] + layer["raw_count"]]
+
+
+    def get_filtered_readings(self, index):
+        layer = self.layers[index]
+        if (self.__filtered_map is None or len(self.__filtered_map) < layer["filtered_offset"] + layer["filtered_count"]):
+            self.__filtered_map = self.__map_file(self.filtered_file_name, self.filtered_dtype, self.__filtered_count)
+        return self.__filtered_map[layer["filtered_offset"]:layer["filtered_offset"] + layer["filtered_count"]]
+
+
+    def get_averages(self):
+        return np.array([self.layers[index]["average"] for index in self.get_layer_indexes()])
+
+
+    def get_heights(self):
+        return np.array([self.layers[index]["height"] for index in self.get_layer_indexes()])
+
+
+    def get_scan_data(self):
+        # Same (layer_volumes, heights_m) pair returned by scann_object. The
+        # layers are sorted by height, as adaptive scans measure them out of
+        # order, see get_layer_heights for their heights.
+        order = np.argsort(self.get_heights(), kind="stable")
+        averages = self.get_averages()[order]
+        heights = self.get_heights()[order]
+        return list(np.diff(averages)), list(heights[:-1])
+
+
+    def get_scan_result(self):
+        # scan_result sorted by height whose raw readings are views of the
+        # memory mapped file, nothing is copied.
+        indexes = sorted(self.get_layer_indexes(), key=lambda index: self.layers[index]["height"])
+        layers = [self.layers[index] for index in indexes]
+        result = scan_result([layer["height"] for layer in layers], 0, ("layer_volumes", "heights_m", "layer_heights") if self.header.get("adaptive", False)
+                             else ("layer_volumes", "heights_m"))
+        result.averages[:] = [layer["average"] for layer in layers]
+        result.samples[:] = [layer.get("samples", layer["raw_count"]) for layer in layers]
+        result.standard_errors[:] = [layer.get("standard_error", np.inf) for layer in layers]
+        for i, layer in enumerate(layers):
+            result.set_timings(i, layer.get("timings", {}))
+        result.raw_readings = self.__map_file(self.raw_file_name, self.raw_dtype, self.__raw_count)
+        result.raw_offsets[:] = [layer["raw_offset"] for layer in layers]
+        result.raw_counts[:] = [layer["raw_count"] for layer in layers]
+        result.raw_capacities[:] = result.raw_counts
+        return result
+
+
+    def get_layer_heights(self):
+        return list(np.diff(np.sort(self.get_heights())))
+
+
+    def __load_layers(self):
+        layers_path = self.path / self.layers_file_name
+        if (not layers_path.exists()):
+            return
+        with open(layers_path, "r") as file:
+            for line in file:
+                try:
+                    layer = json.loads(line)
+                except json.JSONDecodeError:
+                    # Line cut by a crash while it was being written.
+                    continue
+                # A layer measured again later replaces the previous record.
+                self.layers[layer["index"]] = layer
+                self.__raw_count = max(self.__raw_count, layer["raw_offset"] + layer["raw_count"])
+                self.__filtered_count = max(self.__filtered_count, layer["filtered_offset"] + layer["filtered_count"])
+
+
+    def __map_file(self, file_name, dtype, count):
+        # Only the readings of the recorded layers are mapped.
+        if (count == 0):
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.path / file_name, dtype=dtype, mode="r", shape=(count,))
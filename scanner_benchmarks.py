@@ -0,0 +1,525 @@
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+from immersion_scanner_lib import immersion_scanner, connection_types
+from scanner_simulator_lib import simulated_instrument
+from scanner_fleet_lib import scanner_fleet
+from mesh_reconstruction_lib import revolution_mesh
+from scan_replay_lib import scan_replay
+from scan_result_lib import scan_result
+from batch_runner import batch_runner, post_process_scan
+from scanner_session_lib import scanner_session
+from scanner_metrics_lib import scan_metrics
+
+
+def get_synthetic_reading(averages, seed=0, baseline=-250000, noise=8, outliers_ratio=0.01):
+    generator = np.random.default_rng(seed)
+    readings = generator.normal(baseline, noise, averages).round().astype(np.int64)
+    outliers = generator.random(averages) < outliers_ratio
+    readings[outliers] += generator.integers(-3000, 3000, outliers.sum())
+    return ",".join(str(reading) for reading in readings) + ",\r\n"
+
+
+def filter_with_lists(scanner, reading, averages):
+    readings_list = reading.split(",")
+    readings_list.pop()
+    for i in range(len(readings_list)):
+        readings_list[i] = int(readings_list[i]) / scanner.cubic_meter_calibration
+
+    farless_list = readings_list
+    for raw_deviation in scanner.filter_deviations:
+        farless_list = scanner.filter_measures(farless_list, raw_deviation / abs(scanner.cubic_meter_calibration))
+    if (averages < scanner.group_size and len(farless_list) != 0):
+        return sum(farless_list)/len(farless_list)
+    return scanner.get_average_by_filtering_by_deviation(farless_list)
+
+
+def filter_with_arrays(scanner, reading, averages):
+    readings_list = reading.split(",")
+    readings_list.pop()
+    readings_array = np.array(readings_list, dtype=np.int64) / scanner.cubic_meter_calibration
+    return scanner.filter_and_average_readings(readings_array, averages)[1]
+
+
+def time_function(function, repetitions, *args):
+    start_time = time.perf_counter()
+    for _ in range(repetitions):
+        result = function(*args)
+    return (time.perf_counter() - start_time) / repetitions, result
+
+
+def benchmark_filtering(averages_list=(100, 1000, 10000, 50000), repetitions=20):
+    scanner = immersion_scanner(connection_types.simulated)
+    print("averages | lists (ms) | arrays (ms) | speedup | same average")
+    for averages in averages_list:
+        reading = get_synthetic_reading(averages, seed=averages)
+        lists_time, lists_average = time_function(filter_with_lists, repetitions, scanner, reading, averages)
+        arrays_time, arrays_average = time_function(filter_with_arrays, repetitions, scanner, reading, averages)
+        print("%8d | %10.3f | %11.3f | %6.1fx | %s" % (averages, lists_time * 1000, arrays_time * 1000,
+                                                       lists_time / arrays_time, lists_average == arrays_average))
+
+
+def wait_reply_spinning(reply, timeout):
+    # Previous MQTT wait: poll the shared reply slot without sleeping.
+    start_time = time.time()
+    while (time.time() - start_time < timeout):
+        if (reply["value"] != None):
+            return reply["value"]
+    return None
+
+
+def wait_reply_with_condition(reply, timeout):
+    with reply["condition"]:
+        reply["condition"].wait_for(lambda: reply["value"] != None, timeout)
+        return reply["value"]
+
+
+def benchmark_reply_wait(reply_delay=0.2, repetitions=10):
+    # A thread plays the role of the paho network loop delivering the reply.
+    print("wait method | cpu per reply (ms) | cpu usage | wake up latency (ms)")
+    for name, wait_function in (("spinning", wait_reply_spinning), ("condition", wait_reply_with_condition)):
+        cpu_time = 0
+        wall_time = 0
+        latencies = []
+        for _ in range(repetitions):
+            reply = {"value": None, "condition": threading.Condition()}
+
+            def deliver():
+                time.sleep(reply_delay)
+                with reply["condition"]:
+                    reply["delivered"] = time.perf_counter()
+                    reply["value"] = "reply"
+                    reply["condition"].notify_all()
+
+            deliverer = threading.Thread(target=deliver)
+            start_cpu = time.process_time()
+            start_wall = time.perf_counter()
+            deliverer.start()
+            wait_function(reply, 5)
+            latencies.append(time.perf_counter() - reply["delivered"])
+            cpu_time += time.process_time() - start_cpu
+            wall_time += time.perf_counter() - start_wall
+            deliverer.join()
+        print("%11s | %18.3f | %8.1f%% | %20.3f" % (name, cpu_time / repetitions * 1000, cpu_time / wall_time * 100,
+                                                  np.median(latencies) * 1000))
+
+
+def benchmark_mqtt_queries(mqtt_brocker, mqtt_brocker_port=1883, command="*IDN?", repetitions=50):
+    scanner = immersion_scanner(connection_types.mqtt, mqtt_brocker=mqtt_brocker, mqtt_brocker_port=mqtt_brocker_port)
+    latencies = []
+    start_cpu = time.process_time()
+    start_wall = time.perf_counter()
+    for _ in range(repetitions):
+        start_time = time.perf_counter()
+        scanner.query_command(command)
+        latencies.append(time.perf_counter() - start_time)
+    cpu_time = time.process_time() - start_cpu
+    wall_time = time.perf_counter() - start_wall
+    print("median reply latency: %.3f ms, cpu usage: %.1f%%" % (np.median(latencies) * 1000, cpu_time / wall_time * 100))
+
+
+def time_commands(scanner):
+    # Wraps the transport methods of the scanner to keep the latency of each
+    # command, grouped by the command header.
+    latencies = {}
+
+    def timed(function):
+        def timed_function(command, *args):
+            start_time = time.perf_counter()
+            result = function(command, *args)
+            latencies.setdefault(command.split(" ")[0], []).append(time.perf_counter() - start_time)
+            return result
+        return timed_function
+
+    scanner.query_command = timed(scanner.query_command)
+    scanner.query_binary_command = timed(scanner.query_binary_command)
+    scanner.send_command = timed(scanner.send_command)
+    return latencies
+
+
+def get_simulated_scanner(time_scale=50, **simulator_options):
+    # The waits of the scanner are scaled as the simulation, so all the
+    # durations keep the proportions of the real rig.
+    instrument = simulated_instrument(time_scale=time_scale, **simulator_options)
+    scanner = immersion_scanner(connection_types.simulated, simulated_instrument=instrument)
+    for attribute in ("command_delay", "motor_on_time", "motor_off_settle_time", "axis_home_time", "move_time_margin", "operation_complete_poll_interval",
+                      "bulk_read_timeout", "bulk_read_poll_interval", "line_read_delay", "continuous_lag"):
+        setattr(scanner, attribute, getattr(scanner, attribute) / time_scale)
+    return scanner, instrument
+
+
+def benchmark_simulated_scan(layer_count=10, averages=500, time_scale=50, pipelined=False, **simulator_options):
+    # Durations are given in rig seconds, the simulated time divided by time_scale.
+    scanner, instrument = get_simulated_scanner(time_scale, **simulator_options)
+    latencies = time_commands(scanner)
+    start_time = instrument.get_time()
+    scanner.scann_object(0.005, layer_count, averages, pipelined=pipelined)
+    scan_time = instrument.get_time() - start_time
+    print("%d layers of %d averages in %.1f rig s: %.4f layers/s" % (layer_count + 1, averages, scan_time, (layer_count + 1) / scan_time))
+    print("command | count | median latency (rig ms)")
+    for command, command_latencies in sorted(latencies.items()):
+        print("%20s | %5d | %10.2f" % (command, len(command_latencies), np.median(command_latencies) * time_scale * 1000))
+    print("phase | mean per layer (rig s)")
+    for phase in ("motor_on", "move", "motor_off", "acquire", "parse", "filter"):
+        print("%9s | %8.3f" % (phase, np.mean([timings.get(phase, 0) for timings in scanner.last_scan_timings]) * time_scale))
+
+
+def benchmark_filter_throughput(averages_list=(100, 1000, 10000, 100000), repetitions=10):
+    scanner = immersion_scanner(connection_types.simulated)
+    print("averages | ascii samples/s | binary samples/s")
+    for averages in averages_list:
+        ascii_reading = get_synthetic_reading(averages, seed=averages)
+        binary_reading = scanner.parse_buoyancy_values(ascii_reading).astype(scanner.binary_block_dtype)
+        ascii_time = time_function(scanner.process_buoyancy_values, repetitions, ascii_reading, averages)[0]
+        binary_time = time_function(scanner.process_buoyancy_values, repetitions, binary_reading, averages)[0]
+        print("%8d | %15.0f | %16.0f" % (averages, averages / ascii_time, averages / binary_time))
+
+
+def benchmark_fleet(scanners_counts=(1, 2, 4), objects_per_scanner=2, layer_count=5, averages=200, time_scale=50):
+    print("scanners | objects/h (rig) | speedup")
+    base_throughput = None
+    for scanners_count in scanners_counts:
+        fleet = scanner_fleet({"tank_" + str(i): get_simulated_scanner(time_scale, seed=i)[0] for i in range(scanners_count)})
+        for i in range(scanners_count * objects_per_scanner):
+            fleet.submit_scan("object_" + str(i), 0.005, layer_count, averages)
+        fleet.wait()
+        throughput = fleet.get_throughput()["objects_per_hour"] / time_scale
+        fleet.close()
+        if (base_throughput == None):
+            base_throughput = throughput
+        print("%8d | %15.1f | %6.2fx" % (scanners_count, throughput, throughput / base_throughput))
+
+
+def benchmark_streaming(averages_list=(10000, 100000, 1000000, 4000000), chunk_size=10000, time_scale=10000):
+    # The simulator is run very fast, so the time is spent filtering.
+    print("averages | filter | peak memory (MB) | time (s) | average (raw) | standard error (raw)")
+    for averages in averages_list:
+        for streaming in (False, True):
+            scanner = get_simulated_scanner(time_scale, sample_rate=1e6, latency=0, seed=averages)[0]
+            scanner.streaming_chunk_size = chunk_size
+            tracemalloc.start()
+            start_time = time.perf_counter()
+            if (streaming):
+                average, standard_error = scanner.measure_buoyancy_streaming(averages)[:2]
+            else:
+                readings_array, farless_array, average = scanner.process_buoyancy_values(scanner.acquire_buoyancy_values(averages), averages)
+                standard_error = scanner.get_standard_error(farless_array, averages)
+                del readings_array, farless_array
+            elapsed = time.perf_counter() - start_time
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("%8d | %9s | %16.1f | %8.3f | %13.3f | %.5f" % (averages, "streaming" if streaming else "arrays", peak_memory / 1e6, elapsed,
+                                                                  average * scanner.cubic_meter_calibration,
+                                                                  standard_error * abs(scanner.cubic_meter_calibration)))
+
+
+def benchmark_read_to_buffer(lines_counts=(10, 50, 200), time_scale=50):
+    # The lines are sent by the simulator at its sample rate, as the firmware does.
+    print("lines | bulk | lines read | same lines | time (rig s)")
+    for lines_count in lines_counts:
+        buffers = []
+        for bulk_read in (False, True):
+            scanner, instrument = get_simulated_scanner(time_scale, seed=lines_count)
+            scanner.bulk_read = bulk_read
+            start_time = instrument.get_time()
+            complete = scanner.read_to_buffer("MEAS:BUOY:LIST " + str(lines_count))
+            read_time = instrument.get_time() - start_time
+            buffers.append(list(scanner.buffer))
+            print("%5d | %4s | %10d | %10s | %8.2f" % (lines_count, bulk_read, len(scanner.buffer), complete and buffers[0] == buffers[-1], read_time))
+
+
+def benchmark_command_batching(layer_count=5, averages=200, time_scale=50, latency=0.05, queries_count=20):
+    # latency is the rig time of a round trip, as on a slow serial link or brocker.
+    print("batch | writes | query time (rig ms) | move phase (rig s) | layers/s (rig)")
+    for batch_commands in (False, True):
+        scanner, instrument = get_simulated_scanner(time_scale, latency=latency)
+        scanner.batch_commands = batch_commands
+        start_time = instrument.get_time()
+        replies = scanner.execute_batch(["*IDN?"] * queries_count)
+        query_time = instrument.get_time() - start_time
+        if (len(replies) != queries_count):
+            raise ValueError("Missing replies")
+
+        start_commands = instrument.commands_count
+        start_time = instrument.get_time()
+        scanner.scann_object(0.005, layer_count, averages)
+        scan_time = instrument.get_time() - start_time
+        move_time = np.mean([timings.get("motor_on", 0) + timings["move"] for timings in scanner.last_scan_timings]) * time_scale
+        print("%5s | %6d | %19.1f | %18.3f | %.4f" % (batch_commands, instrument.commands_count - start_commands, query_time * 1000,
+                                                     move_time, (layer_count + 1) / scan_time))
+
+
+def get_profile_error(object_profile, layer_volumes, heights, layer_heights):
+    # RMS difference between the radius of the layers and the true radius.
+    profile = np.array(object_profile)
+    heights = np.asarray(heights)
+    tops = heights + np.asarray(layer_heights)
+    sample_heights = np.linspace(heights[0], tops[-1], 10000, endpoint=False)
+    radiuses = immersion_scanner.get_radiuses(layer_volumes, layer_heights)
+    measured_radiuses = radiuses[np.searchsorted(tops, sample_heights, side="right")]
+    true_radiuses = np.interp(sample_heights, profile[:, 0], profile[:, 1])
+    return np.sqrt(np.mean((measured_radiuses - true_radiuses) ** 2))
+
+
+def benchmark_adaptive_layers(height=0.06, coarse_layers=6, refinement=8, averages=200, time_scale=50):
+    # A cylinder with a step and a cone, most of it can be measured with few layers.
+    object_profile = ((0, 0.02), (0.0249, 0.02), (0.025, 0.03), (0.04, 0.03), (0.05, 0.015), (height + 0.01, 0.015))
+    print("scan | stops | rms radius error (mm) | time (rig s)")
+    for adaptive in (False, True):
+        scanner, instrument = get_simulated_scanner(time_scale, object_profile=object_profile, seed=0)
+        start_time = instrument.get_time()
+        if (adaptive):
+            layer_volumes, heights, layer_heights = scanner.scann_object_adaptive(height / coarse_layers, coarse_layers, averages,
+                                                                                  min_layer_height=height / coarse_layers / refinement)
+        else:
+            layer_height = height / coarse_layers / refinement
+            layer_volumes, heights = scanner.scann_object(layer_height, coarse_layers * refinement, averages)
+            layer_heights = [layer_height] * len(heights)
+        scan_time = instrument.get_time() - start_time
+        print("%8s | %5d | %21.3f | %8.1f" % ("adaptive" if adaptive else "uniform", len(scanner.last_scan_timings),
+                                              get_profile_error(object_profile, layer_volumes, heights, layer_heights) * 1000, scan_time))
+
+
+def benchmark_continuous_scan(height=0.05, layer_count=20, averages=200, time_scale=10, seeds=(0, 1, 2, 3, 4)):
+    # Samples are timed by the host, so faster simulations add timing errors.
+    # Every scan is repeated with each seed of the simulated noise.
+    object_profile = ((0, 0.02), (0.0199, 0.02), (0.02, 0.03), (0.035, 0.03), (0.045, 0.015), (height + 0.01, 0.015))
+    print("scan | seed | rms radius error (mm) | volume error | time (rig s)")
+    for continuous in (False, True):
+        volume_errors = []
+        for seed in seeds:
+            scanner, instrument = get_simulated_scanner(time_scale, object_profile=object_profile, seed=seed)
+            true_volume = instrument.get_volume(-height * immersion_scanner.steps_per_m)
+            start_time = instrument.get_time()
+            if (continuous):
+                layer_volumes, heights = scanner.scann_object_continuous(height / layer_count, layer_count, averages)
+            else:
+                layer_volumes, heights = scanner.scann_object(height / layer_count, layer_count, averages)
+            scan_time = instrument.get_time() - start_time
+            volume_errors.append(sum(layer_volumes) / true_volume - 1)
+            print("%10s | %4d | %21.3f | %12.2e | %8.1f" % ("continuous" if continuous else "stop/go", seed,
+                                                           get_profile_error(object_profile, layer_volumes, heights, [height / layer_count] * len(heights)) * 1000,
+                                                           volume_errors[-1], scan_time))
+        print("%10s | volume error from %.2e to %.2e, mean %.2e" % ("continuous" if continuous else "stop/go", min(volume_errors), max(volume_errors),
+                                                                    np.mean(volume_errors)))
+
+
+def benchmark_filter_sweep(scans_count=4, layer_count=10, averages=2000, workers_counts=(1, 2, 4), time_scale=1000):
+    # The scans are recorded once, then every grid is replayed from disk.
+    parameter_grid = scan_replay.get_parameter_grid({"filter_deviations": [(400, 70, 40), (400, 100, 60), (200, 50, 30), (400, 40, 20)],
+                                                     "group_size": [10, 25, 50, 100], "group_accepted_deviation": [10, 25, 50]})
+    directory = tempfile.mkdtemp(prefix="benchmark_sweep_")
+    try:
+        store_paths = []
+        for scan_index in range(scans_count):
+            scanner, instrument = get_simulated_scanner(time_scale, seed=scan_index)
+            store_paths.append(directory + "/scan_" + str(scan_index))
+            scanner.scann_object(0.05 / layer_count, layer_count, averages, store_path=store_paths[-1])
+
+        replay = scan_replay(store_paths[0])
+        result = replay.replay(**{name: getattr(immersion_scanner, name) for name in scan_replay.filter_parameters})
+        print("replay with the scan parameters gives the stored averages:", result["averages"] == result["stored_averages"])
+
+        print("workers | replays | time (s) | replays/s | speedup")
+        reference_time = None
+        for workers_count in workers_counts:
+            start_time = time.perf_counter()
+            results = scan_replay.sweep(store_paths, parameter_grid, max_workers=workers_count)
+            sweep_time = time.perf_counter() - start_time
+            if (reference_time == None):
+                reference_time = sweep_time
+            print("%7d | %7d | %8.2f | %9.1f | %6.2fx" % (workers_count, len(results), sweep_time, len(results) / sweep_time, reference_time / sweep_time))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_drift_tracking(layer_count=10, drift_rate=1.0, time_scale=50, averages_list=(200, 1000)):
+    # drift_rate is in raw units per rig second. The volume errors are in
+    # raw units, the volume of a layer being about 80.
+    print("drift tracking | averages | rms layer error | total volume error | time (rig s)")
+    directory = tempfile.mkdtemp(prefix="benchmark_drift_")
+    try:
+        for drift_tracking in (False, True):
+            for averages in averages_list:
+                scanner, instrument = get_simulated_scanner(time_scale, drift_rate=drift_rate, seed=0)
+                scanner.drift_tracking = drift_tracking
+                positions = [-i * 0.005 * immersion_scanner.steps_per_m for i in range(layer_count + 1)]
+                true_volumes = np.diff([instrument.get_volume(position) for position in positions])
+                start_time = instrument.get_time()
+                result = scanner.scann_object(0.005, layer_count, averages)
+                scan_time = instrument.get_time() - start_time
+                errors = (result.layer_volumes - true_volumes) * scanner.cubic_meter_calibration
+                print("%14s | %8d | %15.2f | %18.2f | %8.1f" % (drift_tracking, averages, np.sqrt(np.mean(errors ** 2)), np.sum(errors), scan_time))
+                if (drift_tracking):
+                    scanner.save_calibration_profile(directory + "/profiles.json")
+        scanner, instrument = get_simulated_scanner(time_scale)
+        scanner.load_calibration_profile(directory + "/profiles.json")
+        print("drift rate in the calibration profile: %.3f raw/rig s" % (scanner.drift_rate / time_scale))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_batch_runner(objects_count=6, scanners_count=2, layer_count=10, averages=200, time_scale=200):
+    # Times are host seconds. Inline scans and post processes the objects
+    # one after the other on a single scanner.
+    print("runner | scanners | objects | post processed | time (s)")
+    directory = tempfile.mkdtemp(prefix="benchmark_batch_")
+    try:
+        scanner = get_simulated_scanner(time_scale, seed=0)[0]
+        start_time = time.perf_counter()
+        for i in range(objects_count):
+            object_directory = directory + "/inline/object_" + str(i)
+            scanner.scann_object(0.005, layer_count, averages, store_path=object_directory + "/scan")
+            post_process_scan(object_directory + "/scan", object_directory)
+        print("%6s | %8d | %7d | %14d | %8.1f" % ("inline", 1, objects_count, objects_count, time.perf_counter() - start_time))
+
+        scanners = {"simulated_" + str(i): get_simulated_scanner(time_scale, seed=i)[0] for i in range(scanners_count)}
+        jobs = [{"object_id": "object_" + str(i), "layer_height": 0.005, "layer_count": layer_count, "averages": averages,
+                 "transport": {"name": "simulated_" + str(i % scanners_count)}} for i in range(objects_count)]
+        runner = batch_runner(directory + "/batch", scanners=scanners)
+        start_time = time.perf_counter()
+        records = runner.run(jobs)
+        print("%6s | %8d | %7d | %14d | %8.1f" % ("batch", scanners_count, objects_count, len([record for record in records if "mesh" in record]),
+                                                 time.perf_counter() - start_time))
+        print("run again, skipped:", len([record for record in runner.run(jobs) if record["state"] == "skipped"]))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_session(layer_count=8, averages=200, time_scale=50, drop_layer=3):
+    # The link is dropped after drop_layer, with and without a restart of
+    # the firmware. Times are in rig ms, the volume error in raw units.
+    print("link drop | layers | reconnect (rig ms) | restore (rig ms) | rms volume error")
+    reference_volumes = None
+    for drop in (None, "link", "restart"):
+        scanner, instrument = get_simulated_scanner(time_scale, seed=0, noise=0, outliers_ratio=0)
+        session = scanner_session(scanner, heartbeat_interval=1, reconnect_interval=0.1, metrics=scan_metrics())
+        drop_link = lambda index, height, average: instrument.drop_link(drop == "restart") if (drop != None and index == drop_layer) else None
+        result = scanner.scann_object(0.005, layer_count, averages, layer_callback=drop_link)
+        session.close()
+        if (reference_volumes is None):
+            reference_volumes = result.layer_volumes
+        spans = {histogram["labels"]["event"]: histogram for histogram in session.metrics.get_summary()["histograms"] if histogram["name"] == "connection"}
+        errors = (result.layer_volumes - reference_volumes) * scanner.cubic_meter_calibration
+        print("%9s | %6d | %18.1f | %16.1f | %16.2f" % (drop, result.measured_count, spans["reconnect"]["sum"] * time_scale * 1000 if "reconnect" in spans else 0,
+                                                       spans["restore"]["sum"] * time_scale * 1000 if "restore" in spans else 0, np.sqrt(np.mean(errors ** 2))))
+
+    # Full set up of a new scanner against the reconnection of an idle one,
+    # found by the heartbeat, in host ms.
+    scanner, instrument = get_simulated_scanner(time_scale)
+    start_time = time.perf_counter()
+    immersion_scanner(connection_types.simulated, simulated_instrument=instrument.open())
+    setup_time = time.perf_counter() - start_time
+    session = scanner_session(scanner, heartbeat_interval=0.2, reconnect_interval=0.05, metrics=scan_metrics())
+    instrument.drop_link()
+    while (session.reconnections == 0):
+        time.sleep(0.01)
+    session.close()
+    reconnect_time = [histogram for histogram in session.metrics.get_summary()["histograms"] if histogram["labels"].get("event") == "reconnect"][0]["sum"]
+    print("new scanner set up: %.1f ms, heartbeat reconnection: %.1f ms" % (setup_time * 1000, reconnect_time * 1000))
+
+
+def get_allocated_size(function, *args):
+    tracemalloc.start()
+    try:
+        kept = function(*args)
+        return tracemalloc.get_traced_memory()[0], kept
+    finally:
+        tracemalloc.stop()
+
+
+def keep_layers_as_lists(scanner, readings):
+    # Raw and filtered readings of every layer as lists of floats.
+    layers = []
+    for reading in readings:
+        measures = list(scanner.get_readings_array(reading) * 1.0)
+        layers.append((measures, list(scanner.filter_and_average_readings(np.array(measures), len(measures))[0])))
+    return layers
+
+
+def keep_layers_as_result(scanner, readings):
+    result = scan_result(np.arange(len(readings)) * 0.001, len(readings[0]))
+    for i, reading in enumerate(readings):
+        measures = scanner.get_readings_array(reading)
+        farless_array, average = scanner.filter_and_average_readings(measures, len(measures))
+        result.set_layer(i, average, reading, standard_error=scanner.get_standard_error(farless_array, len(measures)))
+    return result
+
+
+def benchmark_scan_result_memory(layer_count=500, averages=1000):
+    scanner = immersion_scanner(None)
+    readings = [get_synthetic_reading(averages, seed) for seed in range(layer_count)]
+    readings = [scanner.parse_buoyancy_values(reading) for reading in readings]
+    lists_size = get_allocated_size(keep_layers_as_lists, scanner, readings)[0]
+    result_size, result = get_allocated_size(keep_layers_as_result, scanner, readings)
+    print("%d layers of %d samples: lists %.1f MB, scan_result %.1f MB (%.1f MB of arrays), %.1fx smaller" % (
+        layer_count, averages, lists_size / 1e6, result_size / 1e6, result.nbytes / 1e6, lists_size / result_size))
+
+
+def benchmark_mesh(layers_counts=(100, 1000, 10000), angular_resolution=200):
+    # The export time is the build and the STL write together.
+    print("layers | interpolation | triangles | build (ms) | stl (ms) | ply (ms) | export (ms) | volume error")
+    directory = tempfile.mkdtemp(prefix="benchmark_mesh_")
+    try:
+        for layers_count in layers_counts:
+            layer_height = 0.1 / layers_count
+            heights = np.arange(layers_count) * layer_height
+            radiuses = 0.02 + 0.005 * np.sin(heights * 60)
+            layer_volumes = np.pi * radiuses ** 2 * layer_height
+            # The mesh is a polygon, its volume is slightly below the one of the cylinders.
+            polygon_ratio = angular_resolution / (2 * np.pi) * np.sin(2 * np.pi / angular_resolution)
+            for interpolation in ("step", "linear"):
+                build_time, mesh = time_function(revolution_mesh.from_scan, 1, layer_volumes, heights, None, angular_resolution, 0, 1, interpolation)
+                stl_time = time_function(mesh.write_stl, 1, directory + "/mesh.stl")[0]
+                ply_time = time_function(mesh.write_ply, 1, directory + "/mesh.ply")[0]
+                volume_error = mesh.get_volume() / (np.sum(layer_volumes) * polygon_ratio) - 1
+                print("%6d | %13s | %9d | %10.1f | %8.1f | %8.1f | %11.1f | %.2e" % (layers_count, interpolation, mesh.faces_count, build_time * 1000,
+                                                                                     stl_time * 1000, ply_time * 1000, (build_time + stl_time) * 1000,
+                                                                                     volume_error))
+    finally:
+        shutil.rmtree(directory)
+
+
+def get_import_time(module_name):
+    # Every import is timed in a new interpreter, so nothing is cached.
+    code = ("import sys, time, json\nstart_time = time.perf_counter()\nimport " + module_name +
+            "\nloaded = [name for name in ('matplotlib', 'mpl_toolkits.mplot3d', 'pyvisa', 'paho.mqtt.client') if name in sys.modules]" +
+            "\nprint(json.dumps([time.perf_counter() - start_time, loaded]))")
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark_import_time(modules=("immersion_scanner_lib", "scanner_fleet_lib", "gui"), repetitions=5):
+    print("module | median import time (ms) | heavy modules loaded")
+    for module_name in modules:
+        import_times = []
+        for _ in range(repetitions):
+            import_time, loaded = get_import_time(module_name)
+            import_times.append(import_time)
+        print("%21s | %24.1f | %s" % (module_name, np.median(import_times) * 1000, ", ".join(loaded)))
+
+
+if __name__ == "__main__":
+    benchmark_import_time()
+    benchmark_filtering()
+    benchmark_filter_throughput()
+    benchmark_reply_wait()
+    benchmark_simulated_scan()
+    benchmark_fleet()
+    benchmark_mesh()
+    benchmark_streaming()
+    benchmark_read_to_buffer()
+    benchmark_command_batching()
+    benchmark_adaptive_layers()
+    benchmark_continuous_scan()
+    benchmark_filter_sweep()
+    benchmark_scan_result_memory()
+    benchmark_drift_tracking()
+    benchmark_batch_runner()
+    benchmark_session()
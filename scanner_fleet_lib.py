@@ -0,0 +1,165 @@
+import threading
+import time
+from concurrent.futures import Future
+from immersion_scanner_lib import immersion_scanner, connection_types
+
+
+class scanner_fleet:
+    # Runs scans on several scanners at the same time. Every scanner has a
+    # worker thread that takes the oldest queued job it can run, a job can be
+    # left for any scanner or be tied to one of them by name.
+
+    def __init__(self, scanners):
+        self.scanners = dict(scanners)
+        self.jobs = []
+        self.start_time = None
+        self.__pending_jobs = []
+        self.__closed = False
+        self.__condition = threading.Condition()
+        self.__workers = []
+        for name in self.scanners:
+            worker = threading.Thread(target=self.__run_scanner, args=(name,), daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+
+
+    @staticmethod
+    def from_mqtt(mqtt_brocker, names, mqtt_brocker_port=1883, **scanner_options):
+        # Scanner "name" uses the topics name/commands and name/prints.
+        scanners = {}
+        for name in names:
+            scanners[name] = immersion_scanner(connection_types.mqtt, mqtt_brocker=mqtt_brocker, mqtt_brocker_port=mqtt_brocker_port,
+                                               mqtt_client_id="immersion_scanner_" + name, mqtt_write_topic=name + "/commands",
+                                               mqtt_read_topic=name + "/prints", **scanner_options)
+        return scanner_fleet(scanners)
+
+
+    def submit_scan(self, job_name, layer_height, layer_count, averages, scanner_name=None, **scan_options):
+        # scan_options are given to scann_object. Returns a Future with the
+        # scan_result of the scan.
+        return self.__submit_job(job_name, scanner_name, "scann_object", layer_count + 1, (layer_height, layer_count, averages), scan_options)
+
+
+    def submit_resume(self, job_name, store_path, layers_left, scanner_name=None, **resume_options):
+        # Continues a stored scan with resume_scan, layers_left being the
+        # layers it still has to measure.
+        return self.__submit_job(job_name, scanner_name, "resume_scan", layers_left, (store_path,), resume_options)
+
+
+    def __submit_job(self, job_name, scanner_name, method, layers_total, arguments, options):
+        if (scanner_name != None and scanner_name not in self.scanners):
+            raise ValueError("Unknown scanner: " + str(scanner_name))
+        job = {"name": job_name, "scanner": scanner_name, "state": "queued", "layers_done": 0, "layers_total": layers_total,
+               "submitted": time.time(), "started": None, "finished": None, "error": None,
+               "method": method, "arguments": arguments, "options": options,
+               "cancel_event": threading.Event(), "future": Future()}
+        with self.__condition:
+            if (self.__closed):
+                raise ValueError("The fleet has been closed")
+            if (self.start_time == None):
+                self.start_time = job["submitted"]
+            self.jobs.append(job)
+            self.__pending_jobs.append(job)
+            self.__condition.notify_all()
+        return job["future"]
+
+
+    def cancel_all(self):
+        with self.__condition:
+            for job in self.__pending_jobs:
+                job["state"] = "cancelled"
+                job["future"].cancel()
+            self.__pending_jobs = []
+            for job in self.jobs:
+                job["cancel_event"].set()
+
+
+    def wait(self):
+        for job in list(self.jobs):
+            if (not job["future"].cancelled()):
+                job["future"].exception()
+
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        for worker in self.__workers:
+            worker.join()
+
+
+    def get_progress(self):
+        with self.__condition:
+            return [{key: job[key] for key in ("name", "scanner", "state", "layers_done", "layers_total", "submitted", "started", "finished", "error")}
+                    for job in self.jobs]
+
+
+    def get_throughput(self):
+        with self.__condition:
+            finished_jobs = [job for job in self.jobs if job["state"] == "finished"]
+            layers_done = sum(job["layers_done"] for job in self.jobs)
+            elapsed = time.time() - self.start_time if self.start_time != None else 0
+        if (elapsed == 0):
+            return {"objects": 0, "layers": 0, "objects_per_hour": 0, "layers_per_second": 0, "elapsed": 0}
+        return {"objects": len(finished_jobs), "layers": layers_done, "objects_per_hour": len(finished_jobs) / elapsed * 3600,
+                "layers_per_second": layers_done / elapsed, "elapsed": elapsed}
+
+
+    def print_progress(self):
+        for job in self.get_progress():
+            print("%20s | %10s | %9s | %4d/%d layers" % (job["name"], job["scanner"], job["state"], job["layers_done"], job["layers_total"]))
+        throughput = self.get_throughput()
+        print("%d objects in %.0f s: %.2f objects/h, %.3f layers/s" % (throughput["objects"], throughput["elapsed"],
+                                                                       throughput["objects_per_hour"], throughput["layers_per_second"]))
+
+
+    def __get_job(self, scanner_name):
+        for job in self.__pending_jobs:
+            if (job["scanner"] == None or job["scanner"] == scanner_name):
+                return job
+        return None
+
+
+    def __run_scanner(self, scanner_name):
+        scanner = self.scanners[scanner_name]
+        while (True):
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__closed or self.__get_job(scanner_name) != None)
+                job = self.__get_job(scanner_name)
+                if (job == None):
+                    return
+                self.__pending_jobs.remove(job)
+                job["scanner"] = scanner_name
+                job["state"] = "running"
+                job["started"] = time.time()
+
+            if (not job["future"].set_running_or_notify_cancel()):
+                continue
+            try:
+                result = getattr(scanner, job["method"])(*job["arguments"], **self.__get_scan_options(job))
+            except Exception as e:
+                with self.__condition:
+                    job["state"] = "failed"
+                    job["error"] = str(e)
+                    job["finished"] = time.time()
+                job["future"].set_exception(e)
+            else:
+                with self.__condition:
+                    job["state"] = "cancelled" if job["cancel_event"].is_set() else "finished"
+                    job["finished"] = time.time()
+                job["future"].set_result(result)
+
+
+    def __get_scan_options(self, job):
+        options = dict(job["options"])
+        layer_callback = options.pop("layer_callback", None)
+
+        def count_layer(index, height, average):
+            with self.__condition:
+                job["layers_done"] += 1
+            if (layer_callback != None):
+                layer_callback(index, height, average)
+
+        options["layer_callback"] = count_layer
+        options.setdefault("cancel_event", job["cancel_event"])
+        return options
@@ -0,0 +1,153 @@
+import bisect
+import cProfile
+import json
+import math
+import os
+import pstats
+import threading
+import time
+from pathlib import Path
+
+
+class scan_metrics:
+    # Timing spans and counters of a scanner. A span is a duration kept in a
+    # histogram, a counter only adds values. Both can have labels, like the
+    # command header or the phase of the layer, every set of labels is kept
+    # apart. The durations are in seconds.
+
+    latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+    prometheus_prefix = "immersion_scanner_"
+
+    def __init__(self, profile_layer=None):
+        # With profile_layer the layer with that index is run under cProfile.
+        self.profile_layer = profile_layer
+        self.profile_stats = None
+        self.histograms = {}
+        self.counters = {}
+        self.__lock = threading.Lock()
+
+
+    def add_span(self, name, duration, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.histograms.get(key)
+            if (histogram == None):
+                histogram = {"buckets": [0] * (len(self.latency_buckets) + 1), "count": 0, "sum": 0, "min": math.inf, "max": 0}
+                self.histograms[key] = histogram
+            histogram["buckets"][bisect.bisect_left(self.latency_buckets, duration)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += duration
+            histogram["min"] = min(histogram["min"], duration)
+            histogram["max"] = max(histogram["max"], duration)
+
+
+    def timed(self, name, labels, function, *args):
+        start_time = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.add_span(name, time.perf_counter() - start_time, **labels)
+
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def profile(self, function, *args):
+        # The stats of every profiled call are added to profile_stats.
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args)
+        finally:
+            with self.__lock:
+                if (self.profile_stats == None):
+                    self.profile_stats = pstats.Stats(profiler)
+                else:
+                    self.profile_stats.add(profiler)
+
+
+    def print_profile(self, sort="cumulative", count=25):
+        if (self.profile_stats == None):
+            print("No layer has been profiled")
+            return
+        self.profile_stats.sort_stats(sort).print_stats(count)
+
+
+    def save_profile(self, path):
+        # Can be opened with pstats or snakeviz.
+        if (self.profile_stats != None):
+            self.profile_stats.dump_stats(str(path))
+
+
+    def get_summary(self):
+        with self.__lock:
+            histograms = [dict(histogram, name=name, labels=dict(labels), mean=histogram["sum"] / histogram["count"],
+                               buckets=list(histogram["buckets"]))
+                          for (name, labels), histogram in self.histograms.items()]
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.counters.items()]
+        return {"latency_buckets": list(self.latency_buckets), "histograms": histograms, "counters": counters}
+
+
+    def print_summary(self):
+        summary = self.get_summary()
+        print("span | labels | count | mean (ms) | max (ms)")
+        for histogram in sorted(summary["histograms"], key=lambda histogram: (histogram["name"], str(histogram["labels"]))):
+            print("%18s | %30s | %6d | %9.2f | %9.2f" % (histogram["name"], self.__get_labels_text(histogram["labels"]), histogram["count"],
+                                                        histogram["mean"] * 1000, histogram["max"] * 1000))
+        print("counter | labels | value")
+        for counter in sorted(summary["counters"], key=lambda counter: (counter["name"], str(counter["labels"]))):
+            print("%24s | %20s | %d" % (counter["name"], self.__get_labels_text(counter["labels"]), counter["value"]))
+
+
+    def export_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.get_summary(), file, indent=4)
+
+
+    def export_prometheus(self, path):
+        # Text exposition format, written to a temporary file and renamed so
+        # the node exporter textfile collector never reads half a file.
+        path = Path(path)
+        temporary_path = path.with_name(path.name + ".tmp")
+        with open(temporary_path, "w") as file:
+            file.write(self.get_prometheus_text())
+        os.replace(temporary_path, path)
+
+
+    def get_prometheus_text(self):
+        summary = self.get_summary()
+        lines = []
+        for name in sorted(set(histogram["name"] for histogram in summary["histograms"])):
+            metric_name = self.prometheus_prefix + name + "_seconds"
+            lines.append("# TYPE " + metric_name + " histogram")
+            for histogram in summary["histograms"]:
+                if (histogram["name"] != name):
+                    continue
+                cumulative_count = 0
+                for bucket_bound, bucket_count in zip(list(self.latency_buckets) + ["+Inf"], histogram["buckets"]):
+                    cumulative_count += bucket_count
+                    labels = dict(histogram["labels"], le=str(bucket_bound))
+                    lines.append(metric_name + "_bucket" + self.__get_prometheus_labels(labels) + " " + str(cumulative_count))
+                lines.append(metric_name + "_sum" + self.__get_prometheus_labels(histogram["labels"]) + " " + repr(histogram["sum"]))
+                lines.append(metric_name + "_count" + self.__get_prometheus_labels(histogram["labels"]) + " " + str(histogram["count"]))
+        for name in sorted(set(counter["name"] for counter in summary["counters"])):
+            metric_name = self.prometheus_prefix + name + "_total"
+            lines.append("# TYPE " + metric_name + " counter")
+            for counter in summary["counters"]:
+                if (counter["name"] == name):
+                    lines.append(metric_name + self.__get_prometheus_labels(counter["labels"]) + " " + str(counter["value"]))
+        return "\n".join(lines) + "\n"
+
+
+    @staticmethod
+    def __get_prometheus_labels(labels):
+        if (len(labels) == 0):
+            return ""
+        return "{" + ",".join(key + "=\"" + str(value).replace("\\", "\\\\").replace("\"", "\\\"") + "\"" for key, value in labels.items()) + "}"
+
+
+    @staticmethod
+    def __get_labels_text(labels):
+        return ",".join(key + "=" + str(value) for key, value in labels.items())
@@ -0,0 +1,146 @@
+import sys
+import threading
+import time
+from immersion_scanner_lib import immersion_scanner
+
+
+class scanner_session:
+    # Keeps the link to a scanner alive while it is used. The transport
+    # methods of the scanner go through the session, one call at a time,
+    # and a heartbeat thread queries *IDN? when the link has been idle for
+    # heartbeat_interval seconds. When a call fails with a connection error
+    # or the heartbeat gets no reply, the scanner reconnects, every
+    # reconnect_interval seconds for up to reconnect_timeout seconds, and
+    # its axis state is restored. Calls made meanwhile wait and the failed
+    # call is made again, so a dropped link pauses a scan instead of ending
+    # it. The connection times go to metrics as "connection" spans.
+
+    transport_methods = ("query_command", "query_binary_command", "send_command", "read_command", "read_to_buffer")
+
+    def __init__(self, scanner, heartbeat_interval=5, reconnect_interval=1, reconnect_timeout=300, metrics=None):
+        self.scanner = scanner
+        self.heartbeat_interval = heartbeat_interval
+        self.reconnect_interval = reconnect_interval
+        self.reconnect_timeout = reconnect_timeout
+        self.metrics = metrics if metrics != None else scanner.metrics
+        self.connected = True
+        self.reconnections = 0
+        self.__lock = threading.RLock()
+        self.__closed = threading.Event()
+        self.__recovering = False
+        self.__last_activity = time.monotonic()
+        self.__scanner_methods = {}
+        for name in self.transport_methods:
+            self.__scanner_methods[name] = getattr(scanner, name)
+            setattr(scanner, name, self.__get_session_method(name))
+        self.__heartbeat_thread = threading.Thread(target=self.__run_heartbeat, daemon=True)
+        self.__heartbeat_thread.start()
+
+
+    @staticmethod
+    def connect(metrics=None, session_options=None, **scanner_arguments):
+        # Creates the scanner with scanner_arguments and times its connection.
+        start_time = time.perf_counter()
+        scanner = immersion_scanner(**scanner_arguments)
+        session = scanner_session(scanner, metrics=metrics, **(session_options or {}))
+        session.add_span("connect", time.perf_counter() - start_time)
+        return session
+
+
+    @staticmethod
+    def get_connection_errors():
+        # pyvisa errors are only known when pyvisa has been loaded.
+        errors = (ConnectionError, OSError, TimeoutError, EOFError)
+        if ("pyvisa" in sys.modules):
+            errors = errors + (sys.modules["pyvisa"].errors.VisaIOError,)
+        return errors
+
+
+    def close(self):
+        # The scanner gets its own transport methods back.
+        self.__closed.set()
+        self.__heartbeat_thread.join()
+        for name, method in self.__scanner_methods.items():
+            setattr(self.scanner, name, method)
+
+
+    def recover(self):
+        # Reconnects and restores the state of the axis, called when a link
+        # failure is found.
+        with self.__lock:
+            self.connected = False
+            self.__recovering = True
+            start_time = time.perf_counter()
+            try:
+                while (True):
+                    if (self.__closed.is_set()):
+                        raise ConnectionError("The session has been closed")
+                    try:
+                        attempt_time = time.perf_counter()
+                        firmware_restarted = self.scanner.reconnect()
+                        self.add_span("reconnect", time.perf_counter() - attempt_time)
+                        restore_time = time.perf_counter()
+                        self.scanner.restore_state(firmware_restarted)
+                        self.add_span("restore", time.perf_counter() - restore_time, firmware_restarted=firmware_restarted)
+                        break
+                    except (ValueError,) + self.get_connection_errors() as e:
+                        if (time.perf_counter() - start_time > self.reconnect_timeout):
+                            raise ConnectionError("Could not reconnect to the scanner in " + str(self.reconnect_timeout) + " s") from e
+                        print("Reconnection failed, trying again: " + str(e))
+                        time.sleep(self.reconnect_interval)
+            finally:
+                self.__recovering = False
+            self.connected = True
+            self.reconnections += 1
+            self.__last_activity = time.monotonic()
+            self.add_span("recovery", time.perf_counter() - start_time)
+            print("Link to the scanner restored in %.2f s" % (time.perf_counter() - start_time))
+
+
+    def add_span(self, event, duration, **labels):
+        if (self.metrics != None):
+            self.metrics.add_span("connection", duration, event=event, **labels)
+
+
+    def __get_session_method(self, name):
+        scanner_method = self.__scanner_methods[name]
+
+        def session_method(*args):
+            with self.__lock:
+                # Calls made while restoring the state fail as they are.
+                if (self.__recovering):
+                    return scanner_method(*args)
+                if (not self.connected):
+                    self.recover()
+                try:
+                    result = scanner_method(*args)
+                except self.get_connection_errors() as e:
+                    print("Link to the scanner lost: " + str(e))
+                    if (self.metrics != None):
+                        self.metrics.increment("link_failures", source=name)
+                    self.recover()
+                    result = scanner_method(*args)
+                self.__last_activity = time.monotonic()
+                return result
+        return session_method
+
+
+    def __run_heartbeat(self):
+        while (not self.__closed.wait(self.heartbeat_interval / 4)):
+            if (time.monotonic() - self.__last_activity < self.heartbeat_interval or not self.__lock.acquire(blocking=False)):
+                continue
+            try:
+                if (self.__scanner_methods["query_command"]("*IDN?").strip() == ""):
+                    raise ConnectionError("No reply to the heartbeat")
+                self.__last_activity = time.monotonic()
+            except self.get_connection_errors() as e:
+                print("Heartbeat failed: " + str(e))
+                if (self.metrics != None):
+                    self.metrics.increment("link_failures", source="heartbeat")
+                try:
+                    self.recover()
+                except ConnectionError as e:
+                    # Calls made later try again.
+                    print(str(e))
+            finally:
+                self.__lock.release()
@@ -0,0 +1,293 @@
+import math
+import time
+from collections import deque
+import numpy as np
+from immersion_scanner_lib import immersion_scanner
+
+
+class simulated_instrument:
+    # Simulates the scanner firmware behind the pyvisa resource methods used
+    # by immersion_scanner (write, read, query, read_bytes, bytes_in_buffer,
+    # open and close). Reads wait for the timeout, in ms, when no reply is
+    # coming. drop_link makes every method fail until it is opened again.
+    # The object is described by object_profile, a list of (height, radius)
+    # points in meters measured from its bottom, which touches the liquid at
+    # axis position 0. Moving to negative positions submerges it.
+    # Every duration is divided by time_scale, so the simulation can run
+    # faster than the real rig while keeping the same dynamics.
+
+    identification = "Simulated immersion scanner,SIM,0,1.0"
+
+    def __init__(self, object_profile=((0, 0.02), (0.1, 0.02)), latency=0.005, sample_rate=80, noise=8,
+                 outliers_ratio=0.01, outliers_amplitude=3000, baseline=-250000, drift_rate=0,
+                 settle_amplitude=60, settle_time_constant=1.5, settle_period=0.8, sensor_lag=0.3,
+                 speed=4000, time_scale=1, binary_supported=True, operation_complete_supported=True, seed=None):
+        self.latency = latency
+        self.sample_rate = sample_rate
+        self.noise = noise
+        self.outliers_ratio = outliers_ratio
+        self.outliers_amplitude = outliers_amplitude
+        self.baseline = baseline
+        self.drift_rate = drift_rate
+        self.settle_amplitude = settle_amplitude
+        self.settle_time_constant = settle_time_constant
+        self.settle_period = settle_period
+        self.sensor_lag = sensor_lag
+        self.speed = speed
+        self.time_scale = time_scale
+        self.binary_supported = binary_supported
+        self.operation_complete_supported = operation_complete_supported
+        self.timeout = None
+        self.commands_count = 0
+        self.link_up = True
+        self.__restart_on_open = False
+
+        self.__generator = np.random.default_rng(seed)
+        self.__set_object_profile(object_profile)
+        self.__start_time = time.perf_counter()
+        self.__binary_transfer = False
+        self.__motor_on = False
+        self.__home_offset = 0
+        self.__move_start_position = 0
+        self.__move_target = 0
+        self.__move_start_time = 0
+        self.__disturbance_time = -math.inf
+        self.__busy_until = 0
+        self.__pending_replies = deque()
+        self.__output = bytearray()
+        self.__pending_replies.append((0, b"Instrument setup\r\n"))
+
+
+    def get_time(self):
+        return (time.perf_counter() - self.__start_time) * self.time_scale
+
+
+    def get_position(self):
+        return self.__get_physical_positions(np.array([self.get_time()]))[0] - self.__home_offset
+
+
+    def get_volume(self, position):
+        depth = max(0, -(position + self.__home_offset) / immersion_scanner.steps_per_m)
+        return float(np.interp(depth, self.__depths_table, self.__volumes_table))
+
+
+    def open(self):
+        # Opening the port again, which some boards take as a reset.
+        self.link_up = True
+        if (self.__restart_on_open):
+            self.__restart_on_open = False
+            self.restart()
+        return self
+
+
+    def close(self):
+        self.link_up = False
+
+
+    def drop_link(self, restart=False):
+        # With restart the firmware starts again when the link is opened.
+        self.link_up = False
+        self.__restart_on_open = restart
+
+
+    def restart(self):
+        # The axis stays where it is, its counter starting from 0 there.
+        now = self.get_time()
+        self.__stop(now)
+        self.__home_offset = self.__get_physical_positions(np.array([now]))[0]
+        self.__motor_on = False
+        self.__binary_transfer = False
+        self.__busy_until = now
+        self.__pending_replies.clear()
+        self.__output = bytearray()
+        self.__pending_replies.append((now, b"Instrument setup\r\n"))
+
+
+    def write(self, command):
+        # Commands are run one after the other, so a command sent while the
+        # firmware is still acquiring samples waits for the acquisition.
+        self.__check_link()
+        self.commands_count += 1
+        replies = []
+        for sub_command in command.strip().split(";"):
+            now = max(self.get_time(), self.__busy_until)
+            reply = self.__execute(sub_command.strip().lstrip(":"), now)
+            if (isinstance(reply, list)):
+                # Lines sent one by one as they are measured.
+                self.__pending_replies.extend(reply)
+            elif (reply != None):
+                replies.append(reply)
+        if (len(replies) == 0):
+            return len(command)
+        ready_time = max(self.get_time(), self.__busy_until) + self.latency
+        if (isinstance(replies[0], bytes)):
+            self.__pending_replies.append((ready_time, replies[0] + b"\r\n"))
+        else:
+            self.__pending_replies.append((ready_time, (";".join(replies) + "\r\n").encode()))
+        return len(command)
+
+
+    def read(self):
+        self.__check_link()
+        self.__wait_output(lambda: b"\n" in self.__output)
+        end = self.__output.index(b"\n") + 1
+        reading = bytes(self.__output[:end])
+        del self.__output[:end]
+        return reading.decode("utf-8", errors="replace")
+
+
+    def read_bytes(self, count, break_on_termchar=False):
+        self.__check_link()
+        self.__wait_output(lambda: len(self.__output) >= count)
+        reading = bytes(self.__output[:count])
+        del self.__output[:count]
+        return reading
+
+
+    def query(self, command):
+        self.write(command)
+        return self.read()
+
+
+    @property
+    def bytes_in_buffer(self):
+        self.__check_link()
+        now = self.get_time()
+        while (len(self.__pending_replies) != 0 and self.__pending_replies[0][0] <= now):
+            self.__output += self.__pending_replies.popleft()[1]
+        return len(self.__output)
+
+
+    def __check_link(self):
+        if (not self.link_up):
+            raise ConnectionError("The link to the simulated instrument is down")
+
+
+    def __wait_output(self, output_ready):
+        while (not output_ready()):
+            if (len(self.__pending_replies) == 0):
+                if (self.timeout != None):
+                    time.sleep(self.timeout / 1000 / self.time_scale)
+                raise TimeoutError("VI_ERROR_TMO (-1073807339): Timeout expired before operation completed.")
+            ready_time, reply = self.__pending_replies.popleft()
+            self.__sleep_until(ready_time)
+            self.__output += reply
+
+
+    def __sleep_until(self, simulated_time):
+        remaining = simulated_time - self.get_time()
+        if (remaining > 0):
+            time.sleep(remaining / self.time_scale)
+
+
+    def __execute(self, command, now):
+        words = command.split(" ", 1)
+        header = words[0].upper()
+        argument = words[1].strip() if len(words) > 1 else ""
+
+        if (header == "*IDN?"):
+            return self.identification
+        elif (header == "*OPC?" and self.operation_complete_supported):
+            return "1" if now >= self.__get_move_end_time() else "0"
+        elif (header == "FORM:DATA" and self.binary_supported):
+            self.__binary_transfer = argument.upper().replace(" ", "") == "INT,32"
+        elif (header == "FORM:DATA?" and self.binary_supported):
+            return "INT,32" if self.__binary_transfer else "ASC"
+        elif (header == "OUTP:SPEE"):
+            # Speeds are given in steps per second of the host, see time_scale.
+            self.__stop(now)
+            self.speed = float(argument) / self.time_scale
+        elif (header == "OUTP:SPEE?"):
+            return "%.6f" % (self.speed * self.time_scale)
+        elif (header == "OUTP:MOVE"):
+            self.__move(int(float(argument)) + self.__home_offset, now)
+        elif (header == "CONT:CONF:MOTR:ON"):
+            self.__motor_on = True
+        elif (header == "CONT:CONF:MOTR:OFF"):
+            self.__stop(now)
+            self.__motor_on = False
+            self.__disturbance_time = max(self.__disturbance_time, now)
+        elif (header == "CONT:CONF:AXIS:HOME"):
+            self.__home_offset = self.__get_physical_positions(np.array([now]))[0]
+        elif (header == "CONT:CONF:AXIS:AUHO"):
+            self.__home_offset = 0
+            self.__move(0, now)
+        elif (header == "MEAS:BUOY"):
+            return "%.2f" % np.mean(self.__acquire(int(argument), now))
+        elif (header == "MEAS:BUOY:VALS"):
+            values = self.__acquire(int(argument), now)
+            if (self.__binary_transfer):
+                data = values.astype(immersion_scanner.binary_block_dtype).tobytes()
+                return b"#" + str(len(str(len(data)))).encode() + str(len(data)).encode() + data
+            return ",".join(str(value) for value in values) + ","
+        elif (header == "MEAS:BUOY:LIST"):
+            # One sample per line and an empty line at the end.
+            values = self.__acquire(int(argument), now)
+            ready_times = now + np.arange(1, len(values) + 1) / self.sample_rate + self.latency
+            return [(ready_time, (str(value) + "\r\n").encode()) for ready_time, value in zip(ready_times, values)] + \
+                [(self.__busy_until + self.latency, b"\r\n")]
+        return None
+
+
+    def __acquire(self, count, now):
+        # Samples are taken from now on at sample_rate, so the reply is only
+        # ready once all of them have been taken.
+        times = now + np.arange(count) / self.sample_rate
+        self.__busy_until = now + count / self.sample_rate
+        return self.__get_samples(times)
+
+
+    def __get_samples(self, times):
+        # The load cell sees the volume with a delay of sensor_lag, plus the
+        # damped oscillation of the liquid after the last stop.
+        positions = self.__get_physical_positions(times - self.sensor_lag)
+        depths = np.maximum(0, -positions / immersion_scanner.steps_per_m)
+        volumes = np.interp(depths, self.__depths_table, self.__volumes_table)
+        values = self.baseline + self.drift_rate * times + volumes * immersion_scanner.cubic_meter_calibration
+
+        # Before the first stop the liquid is still.
+        if (self.__disturbance_time != -math.inf):
+            disturbance_times = times - self.__disturbance_time
+            disturbance = self.settle_amplitude * np.exp(-np.maximum(disturbance_times, 0) / self.settle_time_constant) \
+                * np.sin(2 * np.pi * disturbance_times / self.settle_period)
+            values = values + np.where(disturbance_times > 0, disturbance, 0)
+
+        values = values + self.__generator.normal(0, self.noise, len(times))
+        outliers = self.__generator.random(len(times)) < self.outliers_ratio
+        values[outliers] += self.__generator.uniform(-self.outliers_amplitude, self.outliers_amplitude, outliers.sum())
+        return np.rint(values).astype(np.int64)
+
+
+    def __get_physical_positions(self, times):
+        distance = self.__move_target - self.__move_start_position
+        travelled = np.clip((times - self.__move_start_time) * self.speed, 0, abs(distance))
+        return self.__move_start_position + math.copysign(1, distance) * travelled
+
+
+    def __get_move_end_time(self):
+        return self.__move_start_time + abs(self.__move_target - self.__move_start_position) / self.speed
+
+
+    def __move(self, target, now):
+        if (not self.__motor_on):
+            return
+        self.__move_start_position = self.__get_physical_positions(np.array([now]))[0]
+        self.__move_target = target
+        self.__move_start_time = now
+        self.__disturbance_time = max(self.__disturbance_time, self.__get_move_end_time())
+
+
+    def __stop(self, now):
+        position = self.__get_physical_positions(np.array([now]))[0]
+        if (position != self.__move_target):
+            self.__move_start_position = position
+            self.__move_target = position
+            self.__move_start_time = now
+
+
+    def __set_object_profile(self, object_profile):
+        profile = np.array(object_profile, dtype=np.float64)
+        self.__depths_table = np.linspace(0, profile[-1, 0], 10001)
+        radiuses = np.interp(self.__depths_table, profile[:, 0], profile[:, 1])
+        areas = np.pi * radiuses ** 2
+        self.__volumes_table = np.concatenate(([0], np.cumsum((areas[1:] + areas[:-1]) / 2 * np.diff(self.__depths_table))))
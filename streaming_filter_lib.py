@@ -0,0 +1,101 @@
+import math
+import numpy as np
+
+
+class streaming_estimator:
+    # Filtered average of the buoyancy samples taken chunk by chunk, with
+    # memory bounded by the chunk size. Follows the rules of
+    # filter_and_average_readings: samples further than accepted_deviation
+    # from the average are rejected, and the accepted samples are averaged
+    # in groups of groups_size, keeping the groups with a standard deviation
+    # below accepted_group_deviation. As the full list is never kept, the
+    # samples are compared with a provisional center: the median of the first
+    # calibration_size samples, then the running mean of the accepted ones.
+    # Means and variances are kept with Welford's method.
+
+    def __init__(self, accepted_deviation, groups_size=50, accepted_group_deviation=math.inf, calibration_size=200):
+        self.accepted_deviation = accepted_deviation
+        self.groups_size = groups_size
+        self.accepted_group_deviation = accepted_group_deviation
+        self.calibration_size = calibration_size
+        self.center = None
+        self.count = 0
+        self.rejected_samples = 0
+        self.rejected_groups = 0
+        self.samples_statistics = (0, 0.0, 0.0)
+        self.groups_statistics = (0, 0.0, 0.0)
+        self.__calibration_chunks = []
+        self.__group_remainder = np.empty(0)
+
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.count += len(values)
+        if (self.center == None):
+            self.__calibration_chunks.append(values)
+            if (sum(len(chunk) for chunk in self.__calibration_chunks) < self.calibration_size):
+                return
+            self.__calibrate()
+            return
+        self.__add_filtered(values)
+
+
+    def finish(self):
+        # Uses the samples kept for the calibration when there were not enough.
+        if (self.center == None and len(self.__calibration_chunks) != 0):
+            self.__calibrate()
+
+
+    def get_average(self):
+        if (self.count < self.groups_size):
+            if (self.samples_statistics[0] == 0):
+                return None
+            return self.samples_statistics[1]
+        if (self.groups_statistics[0] == 0):
+            return None
+        return self.groups_statistics[1]
+
+
+    def get_standard_error(self):
+        count, mean, m2 = self.samples_statistics if self.count < self.groups_size else self.groups_statistics
+        if (count < 2):
+            return math.inf
+        return math.sqrt(m2 / (count - 1) / count)
+
+
+    def __calibrate(self):
+        values = np.concatenate(self.__calibration_chunks)
+        self.__calibration_chunks = []
+        self.center = float(np.median(values))
+        self.__add_filtered(values)
+
+
+    def __add_filtered(self, values):
+        accepted = values[np.abs(values - self.center) < self.accepted_deviation]
+        self.rejected_samples += len(values) - len(accepted)
+        if (len(accepted) == 0):
+            return
+        self.samples_statistics = self.__merge(self.samples_statistics, len(accepted), np.mean(accepted), np.var(accepted) * len(accepted))
+        self.center = self.samples_statistics[1]
+
+        # Samples that do not fill a group wait for the next chunk.
+        grouped = np.concatenate((self.__group_remainder, accepted))
+        groups_count = len(grouped) // self.groups_size
+        self.__group_remainder = grouped[groups_count * self.groups_size:].copy()
+        if (groups_count == 0):
+            return
+        groups = grouped[:groups_count * self.groups_size].reshape(groups_count, self.groups_size)
+        groups_averages = np.mean(groups, axis=1)[np.std(groups, axis=1) < self.accepted_group_deviation]
+        self.rejected_groups += groups_count - len(groups_averages)
+        if (len(groups_averages) != 0):
+            self.groups_statistics = self.__merge(self.groups_statistics, len(groups_averages), np.mean(groups_averages),
+                                                  np.var(groups_averages) * len(groups_averages))
+
+
+    @staticmethod
+    def __merge(statistics, count, mean, m2):
+        # Welford's update for a whole chunk (Chan et al.).
+        previous_count, previous_mean, previous_m2 = statistics
+        total_count = previous_count + count
+        delta = mean - previous_mean
+        return (total_count, previous_mean + delta * count / total_count, previous_m2 + m2 + delta ** 2 * previous_count * count / total_count)